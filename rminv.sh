@@ -1,14 +1,7 @@
-# Prepare the remote directory to run locally
+# Verify the cache and quarantine invalid archives
 CACHE=${1:-cache}
 
 
-# Remove tmp files from crashed runs
-echo "Removing .tmp files from downloader"
-rm -f "$CACHE/*.tmp"
-
-for fn in "$CACHE"/*; do
-    # Skip .sig files
-    [[ "$fn" == *.tar.gz ]] || continue
-    echo "Verifying $fn"
-    gunzip -t "$fn" || (echo "Corrupted file $fn" && rm "$fn")
-done
\ No newline at end of file
+# Partial downloads (.tmp) from crashed runs are kept, evlav resumes them
+# Archives verified by a previous run are skipped unless they changed
+python3 -m evlav verify --cache "$CACHE"
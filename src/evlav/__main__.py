@@ -2,16 +2,40 @@ import argparse
 import logging
 import os
 
-from .index import get_repos
-from .sources import find_and_push_latest, get_tags, prepare_repo, process_repo
+from .index import Repository, get_all_repos
+from .sources import (
+    LOOKAHEAD,
+    LOOKAHEAD_MEMORY,
+    PARALLEL_PUSHES,
+    PARALLEL_VERSIONS,
+    PUSH_BYTES,
+    PUSH_SECONDS,
+    PushScheduler,
+    download_all,
+    find_and_push_latest,
+    get_plans,
+    get_tags,
+    prepare_repo,
+    process_branches,
+    process_repo,
+)
+from .trace import span, start_trace, stop_trace
+from .verify import verify_cache
 
 logger = logging.getLogger(__name__)
 
 
-def _main():
+def _main(argv: list[str] | None = None):
     parser = argparse.ArgumentParser(
         description="SteamOS sources repository sync script."
     )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["sync", "verify", "download"],
+        default="sync",
+        help="'sync' (default) updates the repositories. 'verify' checks the archives in the cache and moves invalid ones to its quarantine directory. 'download' fills the cache with every archive of the indexes, largest first, splitting large ones over several connections.",
+    )
     parser.add_argument(
         "--sources",
         type=str,
@@ -74,6 +98,17 @@ def _main():
         default="./work",
         help="Path to a local scratch directory for processing repositories.",
     )
+    parser.add_argument(
+        "--fresh-clone",
+        action="store_true",
+        help="Delete the clones of the repositories in the work directory and clone them again, instead of fetching into them.",
+    )
+    parser.add_argument(
+        "--clone-filter",
+        type=str,
+        default=None,
+        help="Partial clone filter for new clones of the repositories (e.g., blob:none), so a cold start only downloads the commits and trees. Missing file contents are fetched when needed.",
+    )
     parser.add_argument(
         "--skip-existing",
         action="store_true",
@@ -89,6 +124,23 @@ def _main():
         action="store_true",
         help="Push all internal repositories and skip updating package repositories.",
     )
+    parser.add_argument(
+        "--parallel-pushes",
+        type=int,
+        default=PARALLEL_PUSHES,
+        help="The number of internal repositories to extract and push at the same time.",
+    )
+    parser.add_argument(
+        "--parallel-versions",
+        type=int,
+        default=PARALLEL_VERSIONS,
+        help="The number of versions to process at the same time after the trunk, each in its own git worktree. Above 1, pushes are only combined within a version.",
+    )
+    parser.add_argument(
+        "--parallel-repos",
+        action="store_true",
+        help="Update the history of each repository (e.g., holo and jupiter) in its own process, after the internal repositories are pushed.",
+    )
     parser.add_argument(
         "--should-resume",
         action="store_true",
@@ -98,7 +150,53 @@ def _main():
         "--update-interval",
         type=int,
         default=1,
-        help="The number of commits between pushing to remote. 1 is fine for a local remote. 10 is good for a remote like GitHub.",
+        help="The number of commits between pushing to remote. 1 is fine for a local remote. 10 is good for a remote like GitHub. The branches of all versions of a repository are pushed together.",
+    )
+    parser.add_argument(
+        "--push-size",
+        type=int,
+        default=PUSH_BYTES // 1024**2,
+        help="Push once the archives of the commits waiting to be pushed exceed this size in MiB, regardless of --update-interval. 0 disables it.",
+    )
+    parser.add_argument(
+        "--push-seconds",
+        type=int,
+        default=PUSH_SECONDS,
+        help="Push once the oldest commit waiting to be pushed is this many seconds old, regardless of --update-interval. 0 disables it.",
+    )
+    parser.add_argument(
+        "--fast-import",
+        action="store_true",
+        help="Stream all commits of a repository into a single git fast-import process instead of using a worktree. Much faster when rebuilding the history.",
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=LOOKAHEAD,
+        help="The number of updates to decompress in the background while committing. 0 disables it.",
+    )
+    parser.add_argument(
+        "--lookahead-memory",
+        type=int,
+        default=LOOKAHEAD_MEMORY // 1024**2,
+        help="The maximum size in MiB of decompressed files waiting to be committed.",
+    )
+    parser.add_argument(
+        "--verify-workers",
+        type=int,
+        default=None,
+        help="The number of processes used by 'verify' (default: all cores).",
+    )
+    parser.add_argument(
+        "--recheck",
+        action="store_true",
+        help="Make 'verify' check all archives, including the ones that were verified before.",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Write a trace of the run to this file, with spans for each stage, update, package and subprocess. Open it with chrome://tracing or ui.perfetto.dev.",
     )
     parser.add_argument(
         "--user-name",
@@ -113,8 +211,37 @@ def _main():
         default="230880801+evlaV-bot@users.noreply.github.com",
         help="The email to use when committing to the git repository.",
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.command == "verify":
+        bad = verify_cache(args.cache, args.verify_workers, args.recheck)
+        raise SystemExit(1 if bad else 0)
+
+    if args.trace:
+        start_trace(args.trace)
+    try:
+        if args.command == "download":
+            with span("download"):
+                _download(args)
+        else:
+            with span("sync"):
+                _sync(args)
+    finally:
+        stop_trace()
+
 
+def _download(args: argparse.Namespace):
+    all_repos = get_all_repos(
+        repos=args.repo,
+        versions=args.version,
+        sources=args.sources,
+        cache=args.cache,
+        skip_existing=args.skip_existing,
+    )
+    download_all([repo for repos in all_repos.values() for repo in repos], args.cache)
+
+
+def _sync(args: argparse.Namespace):
     remote = args.remote
     if remote.startswith("./"):
         remote = os.path.abspath(remote)
@@ -125,22 +252,33 @@ def _main():
     repo_data = {}
     all_tags = {}
     repo_paths = {}
-    for r in args.repo:
-        trunk, *rest = get_repos(
-            repo=r,
+    with span("get_all_repos"):
+        all_repos = get_all_repos(
+            repos=args.repo,
             versions=args.version,
             sources=args.sources,
             cache=args.cache,
             skip_existing=args.skip_existing,
         )
+    for r in args.repo:
+        trunk, *rest = all_repos[r]
         if push_all:
             repo_paths[r] = ""
             tags = {}
         else:
-            repo_paths[r] = prepare_repo(
-                r, args.work, remote, args.user_name, args.user_email
-            )
-            tags = get_tags(f"{args.work}/{r}", args.version)
+            with span(f"prepare_repo {r}"):
+                repo_paths[r] = prepare_repo(
+                    r,
+                    args.work,
+                    remote,
+                    args.user_name,
+                    args.user_email,
+                    reuse=not args.fresh_clone,
+                    clone_filter=args.clone_filter,
+                )
+                tags = get_tags(
+                    f"{args.work}/{r}", args.version, args.cache, f"{remote}/{r}"
+                )
             if args.should_resume:
                 assert tags, f"No tags found in {r}, would start from scratch!"
         all_tags[r] = tags
@@ -149,24 +287,142 @@ def _main():
         for r in rest:
             pairs.append((r, trunk, tags))
 
+    # Calculate the updates to apply once, for both stages
+    plans = get_plans(pairs) if not push_all else {}
+
     # First, update internal repos
     # In case of failure, we avoid updating jupiter/holo and losing track
     if not args.skip_other_repos:
-        find_and_push_latest(
-            args.cache, args.work, remote, pairs, push_all, args.should_resume
-        )
+        with span("find_and_push_latest"):
+            find_and_push_latest(
+                args.cache,
+                args.work,
+                remote,
+                pairs,
+                push_all,
+                args.should_resume,
+                plans=plans,
+                parallel_pushes=args.parallel_pushes,
+            )
     if push_all:
         return
 
     # Update repositories
+    if args.parallel_repos and len(args.repo) > 1:
+        _sync_parallel(args, repo_data, repo_paths, all_tags, plans, remote)
+        return
+
     for name in args.repo:
         trunk, repos = repo_data[name]
-        repo_path = repo_paths[name]
-        tags = all_tags[name]
+        with span(f"sync {name}"):
+            _sync_repo(
+                args, trunk, repos, repo_paths[name], all_tags[name], plans, remote
+            )
 
-        process_repo(
+
+def _sync_parallel(
+    args: argparse.Namespace,
+    repo_data: dict[str, tuple[Repository, list[Repository]]],
+    repo_paths: dict[str, str],
+    all_tags: dict[str, dict[str, str]],
+    plans: dict[str, list],
+    remote: str,
+):
+    # Forked, so the parsed indexes and plans do not need to be pickled
+    import multiprocessing
+
+    def run(name: str):
+        if args.trace:
+            start_trace(f"{args.trace}.{name}")
+        try:
+            trunk, repos = repo_data[name]
+            with span(f"sync {name}"):
+                _sync_repo(
+                    args, trunk, repos, repo_paths[name], all_tags[name], plans, remote
+                )
+        finally:
+            stop_trace()
+
+    ctx = multiprocessing.get_context("fork")
+    procs = {
+        name: ctx.Process(target=run, args=(name,), name=f"evlav-{name}")
+        for name in args.repo
+    }
+    logger.info(f"Updating {', '.join(procs)} in parallel")
+    for proc in procs.values():
+        proc.start()
+    for proc in procs.values():
+        proc.join()
+
+    failed = [name for name, proc in procs.items() if proc.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Failed to update {', '.join(failed)}")
+
+
+def _sync_repo(
+    args: argparse.Namespace,
+    trunk: Repository,
+    repos: list[Repository],
+    repo_path: str,
+    tags: dict[str, str],
+    plans: dict[str, list],
+    remote: str,
+):
+    pusher = PushScheduler(
+        repo_path,
+        args.update_interval,
+        args.push_size * 1024**2,
+        args.push_seconds,
+    )
+
+    process_repo(
+        trunk,
+        trunk=None,
+        cache=args.cache,
+        tags=tags,
+        repo_path=repo_path,
+        work_dir=args.work,
+        remote=remote,
+        should_resume=args.should_resume,
+        pull_remote=args.replace_url,
+        readme=args.readme,
+        update_interval=args.update_interval,
+        force_push=args.force_push,
+        fast_import=args.fast_import,
+        todo=plans[trunk.name],
+        lookahead=args.lookahead,
+        lookahead_memory=args.lookahead_memory * 1024**2,
+        pusher=pusher,
+    )
+    if args.parallel_versions > 1 and repos:
+        pusher.push()
+        process_branches(
+            repos,
             trunk,
-            trunk=None,
+            cache=args.cache,
+            tags=tags,
+            repo_path=repo_path,
+            work_dir=args.work,
+            todos=plans,
+            parallel_versions=args.parallel_versions,
+            update_interval=args.update_interval,
+            push_bytes=args.push_size * 1024**2,
+            push_seconds=args.push_seconds,
+            lookahead_memory=args.lookahead_memory * 1024**2,
+            remote=remote,
+            should_resume=args.should_resume,
+            pull_remote=args.replace_url,
+            readme=args.readme,
+            force_push=args.force_push,
+            fast_import=args.fast_import,
+            lookahead=args.lookahead,
+        )
+        return
+
+    for repo in repos:
+        process_repo(
+            repo,
+            trunk=trunk,
             cache=args.cache,
             tags=tags,
             repo_path=repo_path,
@@ -177,22 +433,13 @@ def _main():
             readme=args.readme,
             update_interval=args.update_interval,
             force_push=args.force_push,
+            fast_import=args.fast_import,
+            todo=plans[repo.name],
+            lookahead=args.lookahead,
+            lookahead_memory=args.lookahead_memory * 1024**2,
+            pusher=pusher,
         )
-        for repo in repos:
-            process_repo(
-                repo,
-                trunk=trunk,
-                cache=args.cache,
-                tags=tags,
-                repo_path=repo_path,
-                work_dir=args.work,
-                remote=remote,
-                should_resume=args.should_resume,
-                pull_remote=args.replace_url,
-                readme=args.readme,
-                update_interval=args.update_interval,
-                force_push=args.force_push,
-            )
+    pusher.push()
 
 
 def main():
@@ -0,0 +1,444 @@
+"""End-to-end benchmark of a sync against a synthetic mirror.
+
+Generates source packages and indexes in the format of the SteamOS mirror,
+serves them from a local HTTP server and syncs them into local bare
+repositories with `_main`.
+
+Usage: python -m evlav.bench [options] [-- evlav options]"""
+
+import argparse
+import io
+import logging
+import os
+import random
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+REPOS = ["holo", "jupiter"]
+VERSIONS = ["main", "3.5"]
+BASE_DATE = datetime(2024, 1, 1, 10, 0)
+GIT_DATE = "2024-01-01T00:00:00Z"
+# Chance that a package changes in an update after the first one
+CHANGE_RATE = 0.4
+
+
+def _git(*cmd: str, stdin: str | None = None) -> str:
+    env = {**os.environ, "GIT_AUTHOR_DATE": GIT_DATE, "GIT_COMMITTER_DATE": GIT_DATE}
+    result = subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", *cmd],
+        input=stdin,
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    return result.stdout.strip()
+
+
+def _add_file(tar: tarfile.TarFile, name: str, data: bytes, mode: int, mtime: int):
+    ti = tarfile.TarInfo(name)
+    ti.size = len(data)
+    ti.mode = mode
+    ti.mtime = mtime
+    tar.addfile(ti, io.BytesIO(data))
+
+
+def make_internal_repo(path: str, tag: str):
+    # Bare repository with a single commit, tagged for every package version
+    if not os.path.exists(path):
+        _git("init", "-q", "--bare", path)
+        tree = _git("-C", path, "hash-object", "-t", "tree", "-w", "--stdin", stdin="")
+        commit = _git("-C", path, "commit-tree", "-m", "init", tree)
+        _git("-C", path, "update-ref", "refs/heads/main", commit)
+    _git("-C", path, "tag", "-f", tag, "main")
+
+
+def make_package(
+    mirror: str, name: str, version: str, rel: int, file_size: int, with_repo: bool
+) -> str:
+    fn = f"{name}-{version}-{rel}.src.tar.gz"
+    path = os.path.join(mirror, fn)
+    if os.path.exists(path):
+        return fn
+
+    rnd = random.Random(fn)
+    mtime = 1700000000 + rnd.randrange(10**6)
+    # Some versions drop the patch, so updates also remove files
+    with_patch = random.Random(f"{fn}:patch").random() >= 0.25
+    sources = ["fix.patch", "run.sh"] if with_patch else ["run.sh"]
+    if with_repo:
+        sources.append(f"git+https://gitlab.steamos.cloud/jupiter/{name}.git")
+    pkgbuild = (
+        f"pkgname={name}\npkgver={version}\npkgrel={rel}\n"
+        f"url=https://example.com\nsource=({' '.join(repr(s) for s in sources)})\n"
+    ).encode()
+
+    with tarfile.open(path + ".tmp", "w:gz") as tar:
+        _add_file(tar, f"{name}/PKGBUILD", pkgbuild, 0o644, mtime)
+        _add_file(tar, f"{name}/.SRCINFO", pkgbuild, 0o644, mtime)
+        if with_patch:
+            _add_file(tar, f"{name}/fix.patch", f"{version}\n".encode(), 0o644, mtime)
+        _add_file(tar, f"{name}/run.sh", b"#!/bin/sh\necho run\n", 0o755, mtime)
+        # Incompressible, to measure download and blob throughput
+        _add_file(tar, f"{name}/data.bin", rnd.randbytes(file_size), 0o644, mtime)
+        if with_repo:
+            repo = os.path.join(mirror, "repos", name)
+            make_internal_repo(repo, f"v{version}")
+            tar.add(repo, arcname=f"{name}/{name}")
+    os.rename(path + ".tmp", path)
+    return fn
+
+
+def write_index(mirror: str, name: str, rows: list[tuple[str, datetime]]):
+    # Same layout as the listing of the mirror
+    out = ['<html><body><table id="list"><tbody>']
+    for fn, date in rows:
+        size = os.path.getsize(os.path.join(mirror, fn))
+        out.append(
+            f'<tr><td class="link"><a href="{fn}" title="{fn}">{fn}</a></td>'
+            f'<td class="size">{size / 1024:.1f} KiB</td>'
+            f'<td class="date">{date.strftime("%Y-%b-%d %H:%M")}</td></tr>'
+        )
+    out.append("</tbody></table></body></html>")
+    with open(os.path.join(mirror, f"{name}.html"), "w") as f:
+        f.write("\n".join(out))
+
+
+def generate_mirror(
+    mirror: str,
+    packages: int,
+    updates: int,
+    file_size: int,
+    internal: int,
+    fork: int | None = None,
+) -> list[str]:
+    """Creates the packages and indexes of `updates` daily updates. The output
+    only depends on the arguments, so calling it again with more updates adds
+    them on top. Version 3.5 forks from main at update `fork` (default: halfway)
+    with a backport. Returns the names of the internal repositories."""
+    os.makedirs(mirror, exist_ok=True)
+    if fork is None:
+        fork = updates // 2
+
+    internal_repos = []
+    for repo in REPOS:
+        rows = []
+        for u in range(updates):
+            date = BASE_DATE + timedelta(days=u)
+            for p in range(packages):
+                rnd = random.Random(f"{repo}:{u}:{p}")
+                if u and rnd.random() >= CHANGE_RATE:
+                    continue
+                fn = make_package(
+                    mirror, f"{repo}-pkg{p}", f"1.{u}", 1, file_size, p < internal
+                )
+                rows.append((fn, date))
+        write_index(mirror, f"{repo}-main", rows)
+
+        branch = [
+            (fn, date) for fn, date in rows if date <= BASE_DATE + timedelta(days=fork)
+        ]
+        backport = make_package(
+            mirror, f"{repo}-pkg0", f"1.{fork}b", 2, file_size, internal > 0
+        )
+        branch.append((backport, BASE_DATE + timedelta(days=fork, hours=1)))
+        write_index(mirror, f"{repo}-3.5", branch)
+
+        internal_repos.extend(f"{repo}-pkg{p}" for p in range(min(internal, packages)))
+    return internal_repos
+
+
+class MirrorHandler(SimpleHTTPRequestHandler):
+    """Serves `/<repo>-<version>/` as the index and `/<repo>-<version>/<file>`
+    as the file, with keep-alive, Range and ETag support. Each connection is
+    limited to `rate` bytes per second, if set."""
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, rate: int = 0, **kwargs):
+        # Set first, the request is handled by the base constructor
+        self.rate = rate
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        import re
+
+        name = self.path.rstrip("/").rsplit("/", 1)[-1]
+        if self.path.endswith("/"):
+            name += ".html"
+        fn = os.path.join(self.directory, name)
+        if not os.path.isfile(fn):
+            self.send_error(404)
+            return
+
+        st = os.stat(fn)
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start = 0
+        end = st.st_size - 1
+        m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if m:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), end)
+            if start >= st.st_size or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{st.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{st.st_size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        left = end - start + 1
+        with open(fn, "rb") as f:
+            f.seek(start)
+            while left > 0:
+                chunk = f.read(min(left, 64 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                left -= len(chunk)
+                if self.rate:
+                    time.sleep(len(chunk) / self.rate)
+
+
+def serve_mirror(mirror: str, rate: int = 0) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(MirrorHandler, directory=mirror, rate=rate)
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def init_remotes(remote: str, internal_repos: list[str]):
+    # Same as init.sh
+    if os.path.exists(remote):
+        shutil.rmtree(remote)
+    for repo in REPOS + internal_repos:
+        _git("init", "-q", "--bare", os.path.join(remote, repo))
+
+
+class StageTimer:
+    """Times the stages of a sync by wrapping the functions that implement
+    them. Stages that run in threads add up their time across threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: list[str] = []
+        self.times: dict[str, float] = {}
+        self.calls: dict[str, int] = {}
+        self.patched = []
+
+    def wrap(self, obj, attr: str, stage: str):
+        func = getattr(obj, attr)
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.times[stage] = self.times.get(stage, 0) + elapsed
+                    self.calls[stage] = self.calls.get(stage, 0) + 1
+
+        setattr(obj, attr, wrapper)
+        self.stages.append(stage)
+        self.patched.append((obj, attr, func))
+
+    def __enter__(self):
+        from . import __main__ as main
+        from . import index, sources
+
+        self.wrap(main, "get_all_repos", "indexes")
+        self.wrap(index, "fetch_index", "fetch index")
+        self.wrap(main, "find_and_push_latest", "internal repos")
+        self.wrap(sources, "push_internal_repo", "push internal repo")
+        self.wrap(main, "process_repo", "repositories")
+        self.wrap(sources, "download_missing", "download")
+        self.wrap(sources, "stage_update", "stage update")
+        self.wrap(sources, "process_update", "commit update")
+        self.wrap(sources.PushScheduler, "push", "push")
+        return self
+
+    def __exit__(self, *_):
+        for obj, attr, func in reversed(self.patched):
+            setattr(obj, attr, func)
+        self.patched.clear()
+
+
+def run_scenario(name: str, root: str, url: str, evlav_args: list[str]):
+    from .__main__ import _main
+
+    cache = os.path.join(root, "cache")
+    before = _dir_size(cache)
+    argv = [
+        "--sources",
+        url,
+        "--repo",
+        *REPOS,
+        "--cache",
+        cache,
+        "--remote",
+        os.path.join(root, "remote"),
+        "--work",
+        os.path.join(root, "work"),
+        "--version",
+        *VERSIONS,
+        *evlav_args,
+    ]
+
+    with StageTimer() as timer:
+        start = time.perf_counter()
+        _main(argv)
+        total = time.perf_counter() - start
+
+    downloaded = _dir_size(cache) - before
+    print(f"{name}: {total:.2f}s, {downloaded / 1024**2:.1f} MiB downloaded")
+    for stage in timer.stages:
+        if stage in timer.times:
+            print(
+                f"  {stage:20s} {timer.times[stage]:8.2f}s {timer.calls[stage]:6d} calls"
+            )
+
+
+def _dir_size(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(path, fn))
+        for fn in os.listdir(path)
+        if os.path.isfile(os.path.join(path, fn))
+    )
+
+
+def _main():
+    import tempfile
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark a sync against a synthetic mirror."
+    )
+    parser.add_argument(
+        "--packages",
+        type=int,
+        default=20,
+        help="The number of packages in each repository.",
+    )
+    parser.add_argument(
+        "--updates",
+        type=int,
+        default=20,
+        help="The number of updates of each repository for the cold and warm runs. The incremental run adds one more.",
+    )
+    parser.add_argument(
+        "--file-size",
+        type=int,
+        default=256,
+        help="The size in KiB of the incompressible file in each package.",
+    )
+    parser.add_argument(
+        "--internal",
+        type=int,
+        default=2,
+        help="The number of packages per repository that embed an internal git repository.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=int,
+        default=0,
+        help="Limit each connection to the mirror to this many KiB/s, like a server that throttles per connection (default: unlimited).",
+    )
+    parser.add_argument(
+        "--dir",
+        type=str,
+        default=None,
+        help="Directory for the mirror, cache, work and remote directories (default: a temporary directory that is removed afterwards).",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Show the log of the sync runs.",
+    )
+    parser.add_argument(
+        "evlav_args",
+        nargs=argparse.REMAINDER,
+        help="Options passed to evlav after '--', e.g. '-- --fast-import'.",
+    )
+    args = parser.parse_args()
+    evlav_args = (
+        args.evlav_args[1:] if args.evlav_args[:1] == ["--"] else args.evlav_args
+    )
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(levelname)s: %(message)s",
+    )
+
+    root = os.path.abspath(args.dir or tempfile.mkdtemp(prefix="evlav-bench-"))
+    mirror = os.path.join(root, "mirror")
+    server = None
+    try:
+        start = time.perf_counter()
+        internal_repos = generate_mirror(
+            mirror, args.packages, args.updates, args.file_size * 1024, args.internal
+        )
+        print(
+            f"Generated mirror with {args.packages} packages and {args.updates} "
+            f"updates per repository in {time.perf_counter() - start:.2f}s"
+        )
+        server = serve_mirror(mirror, args.rate * 1024)
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        # Nothing cached
+        for d in ("cache", "work"):
+            shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+        init_remotes(os.path.join(root, "remote"), internal_repos)
+        run_scenario("cold", root, url, evlav_args)
+
+        # Everything cached, history rebuilt into empty remotes
+        init_remotes(os.path.join(root, "remote"), internal_repos)
+        run_scenario("warm", root, url, evlav_args)
+
+        # One new update on top of the existing history
+        generate_mirror(
+            mirror,
+            args.packages,
+            args.updates + 1,
+            args.file_size * 1024,
+            args.internal,
+        )
+        run_scenario("incremental", root, url, evlav_args)
+    finally:
+        if server:
+            server.shutdown()
+        if not args.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    _main()
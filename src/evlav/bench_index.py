@@ -0,0 +1,89 @@
+"""Benchmark of index parsing on synthetic indexes.
+
+Times a full parse, building the timeline, and parse_index with an empty,
+unchanged and appended row cache, as well as finding the fork point of a
+branch.
+
+Usage: python -m evlav.bench_index [rows...]"""
+
+import argparse
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from .index import IndexParser, build_timeline, parse_index
+from .metadata import MetadataStore
+
+START = datetime(2022, 1, 1)
+
+
+def make_index(n: int) -> bytes:
+    # ~10 packages per update, in the listing format
+    rows = []
+    for i in range(n):
+        date = (START + timedelta(minutes=i // 10)).strftime("%Y-%b-%d %H:%M")
+        name = f"pkg{i % 5000}-1.{i}-1.src.tar.gz"
+        rows.append(
+            f'<tr><td class="link"><a href="{name}" title="{name}">{name}</a></td>'
+            f'<td class="size">1.5 MiB</td><td class="date">{date}</td></tr>'
+        )
+    return f'<table id="list"><tbody>{"".join(rows)}</tbody></table>'.encode()
+
+
+def benchmark(n: int):
+    html = make_index(n)
+    # A new update at the tail
+    newer = make_index(n + 10)
+
+    t0 = time.perf_counter()
+    parser = IndexParser()
+    parser.feed(html.decode("utf-8"))
+    t1 = time.perf_counter()
+    timeline = build_timeline(parser.packages)
+    t2 = time.perf_counter()
+
+    with tempfile.TemporaryDirectory() as cache:
+        store = MetadataStore(cache)
+        t3 = time.perf_counter()
+        parse_index("bench", html, store)
+        t4 = time.perf_counter()
+        parse_index("bench", html, store)
+        t5 = time.perf_counter()
+        packages = parse_index("bench", newer, store)
+        t6 = time.perf_counter()
+        store.db.close()
+
+    # A branch that forks halfway, found by walking back from its end
+    branch = build_timeline(packages[: n // 2] + packages[n:])
+    t7 = time.perf_counter()
+    fork = branch[-1]
+    while fork not in timeline:
+        fork = fork.prev
+    t8 = time.perf_counter()
+
+    print(
+        f"{n:7d} rows, {len(timeline):6d} updates: parse {t1 - t0:6.3f}s, "
+        f"timeline {t2 - t1:6.3f}s, parse_index first {t4 - t3:6.3f}s, "
+        f"unchanged {t5 - t4:6.3f}s, 10 new rows {t6 - t5:6.3f}s, "
+        f"fork {t8 - t7:6.3f}s"
+    )
+
+
+def _main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark index parsing on synthetic indexes."
+    )
+    parser.add_argument(
+        "rows",
+        type=int,
+        nargs="*",
+        default=[10_000, 50_000, 100_000],
+        help="The number of rows of each index (default: 10000 50000 100000).",
+    )
+    args = parser.parse_args()
+    for n in args.rows:
+        benchmark(n)
+
+
+if __name__ == "__main__":
+    _main()
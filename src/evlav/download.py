@@ -0,0 +1,485 @@
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024**2
+MAX_REDIRECTS = 5
+RETRIES = 5
+BACKOFF = 2.0
+TIMEOUT = 60
+# The index rounds sizes to one decimal of their unit
+SIZE_TOLERANCE = 0.1
+# Files at least this large are downloaded in ranges over several connections
+SPLIT_SIZE = 64 * 1024**2
+SEGMENT_SIZE = 16 * 1024**2
+MAX_CONNECTIONS = 8
+# A connection is added while it raises the throughput by this much
+CONNECTION_GAIN = 1.1
+
+
+class DownloadError(Exception):
+    pass
+
+
+class SizeMismatchError(DownloadError):
+    # Retrying would download the same file again
+    pass
+
+
+class DownloadCancelled(DownloadError):
+    pass
+
+
+def check_cancel(name: str, cancel: threading.Event | None):
+    if cancel is not None and cancel.is_set():
+        raise DownloadCancelled(f"Download of '{name}' was cancelled")
+
+
+def backoff_wait(name: str, delay: float, cancel: threading.Event | None):
+    # Sleeps before a retry, unless the download is cancelled meanwhile
+    if cancel is None:
+        time.sleep(delay)
+    elif cancel.wait(delay):
+        check_cancel(name, cancel)
+
+
+class ConnectionPool:
+    """Thread-safe pool of keep-alive HTTP(S) connections per host."""
+
+    def __init__(self, timeout: float = TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+
+    def _get(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        with self.lock:
+            conns = self.idle.get((scheme, netloc))
+            if conns:
+                return conns.pop()
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        if scheme == "http":
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise DownloadError(f"Unsupported URL scheme '{scheme}'")
+
+    def release(self, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse):
+        # Connections can only be reused once the response is fully read
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+            return
+        scheme = "https" if isinstance(conn, http.client.HTTPSConnection) else "http"
+        netloc = (
+            conn.host if conn.port == conn.default_port else f"{conn.host}:{conn.port}"
+        )
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(conn)
+
+    def request(
+        self, url: str, headers: dict[str, str] | None = None, method: str = "GET"
+    ) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse, str]:
+        # Returns the connection, the response and the final url after redirects
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+
+            conn = self._get(parts.scheme, parts.netloc)
+            hdrs = {"User-Agent": "evlav", **(headers or {})}
+            try:
+                conn.request(method, path, headers=hdrs)
+                resp = conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                # Idle keep-alive connections may have been closed by the
+                # server, retry once on a new socket
+                conn.close()
+                try:
+                    conn.request(method, path, headers=hdrs)
+                    resp = conn.getresponse()
+                except Exception:
+                    conn.close()
+                    raise
+
+            location = resp.getheader("Location")
+            if resp.status in (301, 302, 303, 307, 308) and location:
+                resp.read()
+                self.release(conn, resp)
+                url = urljoin(url, location)
+                continue
+            return conn, resp, url
+
+        raise DownloadError(f"Too many redirects for {url}")
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def check_size(name: str, actual: int, expected: int | None):
+    if expected and abs(actual - expected) > expected * SIZE_TOLERANCE:
+        raise SizeMismatchError(
+            f"Size of '{name}' is {actual} bytes, index lists {expected} bytes"
+        )
+
+
+def _download(
+    pool: ConnectionPool,
+    url: str,
+    fn: str,
+    size: int | None,
+    cancel: threading.Event | None = None,
+):
+    tmp = f"{fn}.tmp"
+    name = os.path.basename(fn)
+    offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    conn, resp, _ = pool.request(url, headers)
+    try:
+        if resp.status == 416 and offset:
+            # The partial file is complete or larger than the remote file
+            resp.read()
+            total = resp.getheader("Content-Range", "").rsplit("/", 1)[-1]
+            if total.isdigit() and int(total) == offset:
+                check_size(name, offset, size)
+                os.rename(tmp, fn)
+                return
+            os.remove(tmp)
+            raise DownloadError(f"Partial download of '{name}' is invalid")
+        if resp.status == 206:
+            crange = resp.getheader("Content-Range", "")
+            if not crange.startswith(f"bytes {offset}-"):
+                raise DownloadError(f"Unexpected range '{crange}' for '{name}'")
+            total = crange.rsplit("/", 1)[-1]
+            total = int(total) if total.isdigit() else None
+            mode = "ab"
+            logger.info(f"Resuming '{name}' from {offset / 1024**2:.2f} MiB")
+        elif resp.status == 200:
+            length = resp.getheader("Content-Length")
+            total = int(length) if length and length.isdigit() else None
+            offset = 0
+            mode = "wb"
+        else:
+            resp.read()
+            raise DownloadError(f"HTTP {resp.status} {resp.reason} for '{name}'")
+
+        with open(tmp, mode) as f:
+            while chunk := resp.read(CHUNK_SIZE):
+                f.write(chunk)
+                offset += len(chunk)
+                check_cancel(name, cancel)
+    finally:
+        pool.release(conn, resp)
+
+    if total is not None and offset != total:
+        raise DownloadError(f"Download of '{name}' ended at {offset}/{total} bytes")
+    try:
+        check_size(name, offset, size)
+    except DownloadError:
+        os.remove(tmp)
+        raise
+    os.rename(tmp, fn)
+
+
+class SplitDownload:
+    """Downloads a file in segments over several connections, which are
+    written in place to `fn`.tmp. The finished segments are recorded in
+    `fn`.parts, so an interrupted download resumes with the missing ones.
+
+    It starts with two connections and adds one each time the throughput of
+    the last segments grew by CONNECTION_GAIN, up to `connections`."""
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        url: str,
+        fn: str,
+        total: int,
+        connections: int = MAX_CONNECTIONS,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        cancel: threading.Event | None = None,
+    ):
+        self.pool = pool
+        self.url = url
+        self.fn = fn
+        self.name = os.path.basename(fn)
+        self.total = total
+        self.connections = connections
+        self.retries = retries
+        self.backoff = backoff
+        self.cancel = cancel
+
+        self.lock = threading.Lock()
+        self.todo: list[int] = []
+        self.done: set[int] = set()
+        self.errors: list[Exception] = []
+        self.workers: list[threading.Thread] = []
+        # Throughput measurement since the last added connection
+        self.best = 0.0
+        self.since = 0.0
+        self.received = 0
+        self.segments = 0
+
+    def _load_parts(self) -> set[int]:
+        tmp = f"{self.fn}.tmp"
+        if not os.path.exists(tmp):
+            return set()
+        if os.path.exists(f"{self.fn}.parts"):
+            with open(f"{self.fn}.parts") as f:
+                parts = json.load(f)
+            if parts.get("total") == self.total:
+                return set(parts["done"])
+            return set()
+        # A partial download of a single connection, which never reaches the
+        # full size as it is renamed once complete
+        have = os.path.getsize(tmp)
+        if have >= self.total:
+            return set()
+        return set(range(0, have - SEGMENT_SIZE + 1, SEGMENT_SIZE))
+
+    def _save_parts(self):
+        # Called with the lock held
+        with open(f"{self.fn}.parts.tmp", "w") as f:
+            json.dump({"total": self.total, "done": sorted(self.done)}, f)
+        os.replace(f"{self.fn}.parts.tmp", f"{self.fn}.parts")
+
+    def _fetch(self, fd: int, start: int):
+        end = min(start + SEGMENT_SIZE, self.total) - 1
+        conn, resp, _ = self.pool.request(self.url, {"Range": f"bytes={start}-{end}"})
+        try:
+            crange = resp.getheader("Content-Range", "")
+            if resp.status != 206 or not crange.startswith(f"bytes {start}-{end}/"):
+                resp.read()
+                raise DownloadError(
+                    f"Unexpected response {resp.status} '{crange}' for '{self.name}'"
+                )
+            offset = start
+            while chunk := resp.read(CHUNK_SIZE):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                with self.lock:
+                    self.received += len(chunk)
+                check_cancel(self.name, self.cancel)
+        finally:
+            self.pool.release(conn, resp)
+        if offset != end + 1:
+            raise DownloadError(
+                f"Segment {start} of '{self.name}' ended at {offset}/{end + 1} bytes"
+            )
+
+    def _worker(self, fd: int):
+        while True:
+            with self.lock:
+                if not self.todo or self.errors:
+                    return
+                if self.cancel is not None and self.cancel.is_set():
+                    return
+                start = self.todo.pop(0)
+
+            for attempt in range(self.retries):
+                try:
+                    self._fetch(fd, start)
+                    break
+                except (OSError, http.client.HTTPException, DownloadError) as e:
+                    if attempt + 1 == self.retries or isinstance(e, DownloadCancelled):
+                        with self.lock:
+                            self.errors.append(e)
+                        return
+                    try:
+                        backoff_wait(self.name, self.backoff * 2**attempt, self.cancel)
+                    except DownloadCancelled as e:
+                        with self.lock:
+                            self.errors.append(e)
+                        return
+
+            with self.lock:
+                self.done.add(start)
+                self._save_parts()
+                self.segments += 1
+                self._adapt(fd)
+
+    def _adapt(self, fd: int):
+        # Called with the lock held, after every segment
+        if self.segments < len(self.workers) or len(self.workers) >= self.connections:
+            return
+        now = time.monotonic()
+        rate = self.received / max(now - self.since, 1e-6)
+        if rate < self.best * CONNECTION_GAIN:
+            # More connections stopped paying off
+            self.connections = len(self.workers)
+            return
+        self.best = rate
+        self.since = now
+        self.received = 0
+        self.segments = 0
+        if self.todo:
+            self._start(fd)
+
+    def _start(self, fd: int):
+        t = threading.Thread(
+            target=self._worker, args=(fd,), name=f"{self.name}-{len(self.workers)}"
+        )
+        self.workers.append(t)
+        t.start()
+
+    def run(self):
+        tmp = f"{self.fn}.tmp"
+        self.done = self._load_parts()
+        self.todo = [
+            start
+            for start in range(0, self.total, SEGMENT_SIZE)
+            if start not in self.done
+        ]
+        if self.done:
+            logger.info(
+                f"Resuming '{self.name}' with {len(self.todo)} segments missing"
+            )
+
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Recorded before the file is extended, so its size is never taken
+            # for the progress of a single connection
+            with self.lock:
+                self._save_parts()
+            os.ftruncate(fd, self.total)
+            self.since = time.monotonic()
+            with self.lock:
+                for _ in range(min(2, self.connections, len(self.todo))):
+                    self._start(fd)
+            # Workers may start others until the last one exits
+            i = 0
+            while True:
+                with self.lock:
+                    if i >= len(self.workers):
+                        break
+                    t = self.workers[i]
+                t.join()
+                i += 1
+        finally:
+            os.close(fd)
+
+        check_cancel(self.name, self.cancel)
+        if self.errors:
+            raise DownloadError(
+                f"Failed to download '{self.name}' in segments: {self.errors[0]}"
+            )
+        if len(self.done) != len(range(0, self.total, SEGMENT_SIZE)):
+            raise DownloadError(f"Segments of '{self.name}' are missing")
+        logger.info(
+            f"Downloaded '{self.name}' over up to {len(self.workers)} connections"
+        )
+        os.rename(tmp, self.fn)
+        if os.path.exists(f"{self.fn}.parts"):
+            os.remove(f"{self.fn}.parts")
+
+
+def get_remote_size(pool: ConnectionPool, url: str) -> int | None:
+    # The size of the file if the server supports Range requests
+    conn, resp, _ = pool.request(url, {"Range": "bytes=0-0"})
+    crange = resp.getheader("Content-Range", "")
+    if resp.status != 206 or not crange.startswith("bytes 0-0/"):
+        # Without support for ranges, this may be the whole file
+        conn.close()
+        return None
+    try:
+        resp.read()
+    finally:
+        pool.release(conn, resp)
+    total = crange.rsplit("/", 1)[-1]
+    return int(total) if total.isdigit() else None
+
+
+def download(
+    pool: ConnectionPool,
+    url: str,
+    fn: str,
+    size: int | None = None,
+    retries: int = RETRIES,
+    backoff: float = BACKOFF,
+    connections: int = MAX_CONNECTIONS,
+    cancel: threading.Event | None = None,
+):
+    """Downloads `url` to `fn` through `fn`.tmp, resuming a previous partial
+    download with a Range request. Retries with exponential backoff. Files of
+    at least SPLIT_SIZE are downloaded in segments over several connections,
+    if the server supports it. Setting `cancel` stops the download after the
+    chunk in progress with DownloadCancelled, keeping the partial file.
+
+    Processes sharing the cache take a lock on `fn`.lock, so only one of them
+    downloads a file and the others wait for it."""
+    import fcntl
+
+    with open(f"{fn}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(fn):
+            # Downloaded by another process, the other waiters may have
+            # removed the lock file already
+            try:
+                os.remove(f"{fn}.lock")
+            except FileNotFoundError:
+                pass
+            return
+        total = None
+        if connections > 1 and size and size >= SPLIT_SIZE:
+            try:
+                total = get_remote_size(pool, url)
+            except (OSError, http.client.HTTPException, DownloadError):
+                pass
+        if total:
+            check_size(os.path.basename(fn), total, size)
+            SplitDownload(
+                pool, url, fn, total, connections, retries, backoff, cancel
+            ).run()
+        else:
+            if os.path.exists(f"{fn}.parts"):
+                # The partial file of a split download is not contiguous
+                os.remove(f"{fn}.parts")
+                if os.path.exists(f"{fn}.tmp"):
+                    os.remove(f"{fn}.tmp")
+            _download_retry(pool, url, fn, size, retries, backoff, cancel)
+        # Removed only on success and while locked, so processes that
+        # open a new lock file after this will find fn
+        os.remove(f"{fn}.lock")
+
+
+def _download_retry(
+    pool: ConnectionPool,
+    url: str,
+    fn: str,
+    size: int | None,
+    retries: int,
+    backoff: float,
+    cancel: threading.Event | None = None,
+):
+    for attempt in range(retries):
+        try:
+            _download(pool, url, fn, size, cancel)
+            return
+        except (SizeMismatchError, DownloadCancelled):
+            raise
+        except (OSError, http.client.HTTPException, DownloadError) as e:
+            if attempt + 1 == retries:
+                raise DownloadError(
+                    f"Failed to download '{os.path.basename(fn)}': {e}"
+                ) from e
+            delay = backoff * 2**attempt
+            logger.info(
+                f"Download of '{os.path.basename(fn)}' failed ({e}), retrying in {delay:.0f}s"
+            )
+            backoff_wait(os.path.basename(fn), delay, cancel)
@@ -0,0 +1,156 @@
+import logging
+import subprocess
+from datetime import datetime
+
+from .trace import run_cmd, span
+from .tree import Tree, TreeCache
+
+logger = logging.getLogger(__name__)
+
+# Refs written by fast-import, kept out of refs/heads so the checked out
+# branch of the clone is never touched
+REF_PREFIX = "refs/evlav/"
+
+MODE_FILE = 0o100644
+MODE_EXEC = 0o100755
+MODE_LINK = 0o120000
+
+
+def _data(data: bytes) -> bytes:
+    return f"data {len(data)}\n".encode() + data + b"\n"
+
+
+def _date(date: datetime) -> str:
+    # Match `git commit --date <naive iso>`, which uses the local timezone
+    local = date.astimezone()
+    return f"{int(local.timestamp())} {local.strftime('%z')}"
+
+
+class FastImport:
+    """Streams commits into a single long-lived `git fast-import` process.
+
+    No worktree is involved; blobs are written inline and commit hashes are
+    returned through marks. Call `checkpoint()` before other git processes
+    (e.g., a push) need to see the written objects."""
+
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+        self.name = self._config("user.name")
+        self.email = self._config("user.email")
+        self.mark = 0
+        # Commits written by this process can only be referenced by mark
+        # until the next checkpoint
+        self.marks: dict[str, int] = {}
+        # Files of the written commits, used to only write what changed
+        self.trees = TreeCache(repo_path)
+
+        self.proc = subprocess.Popen(
+            ["git", "-C", repo_path, "fast-import", "--quiet", "--force", "--done"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def _config(self, key: str) -> str:
+        return run_cmd(
+            ["git", "-C", self.repo_path, "config", key],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    def _write(self, data: bytes):
+        assert self.proc.stdin
+        try:
+            self.proc.stdin.write(data)
+        except BrokenPipeError:
+            raise RuntimeError("git fast-import exited unexpectedly")
+
+    def _readline(self) -> str:
+        # Waits for fast-import to catch up with the commands written so far
+        assert self.proc.stdin and self.proc.stdout
+        with span("git fast-import", "subprocess"):
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline().decode().strip()
+        if not line:
+            raise RuntimeError("git fast-import exited unexpectedly")
+        return line
+
+    def get_tree(self, ghash: str) -> Tree:
+        try:
+            return self.trees.get(ghash)
+        except RuntimeError:
+            if ghash not in self.marks:
+                raise
+        # Written by us but no longer cached, make it visible to ls-tree
+        self.checkpoint()
+        return self.trees.get(ghash)
+
+    def commit(
+        self,
+        branch: str,
+        parent: str | None,
+        date: datetime,
+        message: str,
+        changes: list[tuple[str, int, bytes] | str],
+        tree: Tree | None = None,
+    ) -> str:
+        """Writes a commit on top of `parent` and returns its hash.
+
+        `changes` are applied in order and contain either a path to delete
+        recursively or a `(path, mode, data)` tuple for a file. `tree` are
+        the files of the resulting commit, if known."""
+        self.mark += 1
+        ref = REF_PREFIX + branch
+        ident = f"{self.name} <{self.email}> {_date(date)}"
+
+        if parent is None:
+            self._write(f"reset {ref}\n".encode())
+        self._write(f"commit {ref}\nmark :{self.mark}\n".encode())
+        self._write(f"author {ident}\ncommitter {ident}\n".encode())
+        # git commit always terminates the message with a newline
+        self._write(_data(message.rstrip("\n").encode() + b"\n"))
+        if parent is not None:
+            ref_from = f":{self.marks[parent]}" if parent in self.marks else parent
+            self._write(f"from {ref_from}\n".encode())
+
+        for change in changes:
+            if isinstance(change, str):
+                self._write(f"D {change}\n".encode())
+            else:
+                path, mode, data = change
+                self._write(f"M {mode:06o} inline {path}\n".encode())
+                self._write(_data(data))
+        self._write(b"\n")
+
+        self._write(f"get-mark :{self.mark}\n".encode())
+        ghash = self._readline()
+        self.marks[ghash] = self.mark
+        if tree is not None:
+            self.trees.put(ghash, tree)
+        return ghash
+
+    def checkpoint(self):
+        # Flush the pack and refs to disk, then wait until that is done
+        self._write(b"checkpoint\nprogress checkpoint\n")
+        self._readline()
+
+    def close(self):
+        assert self.proc.stdin
+        if self.proc.poll() is None:
+            try:
+                self._write(b"done\n")
+                self.proc.stdin.close()
+            except (BrokenPipeError, RuntimeError):
+                pass
+        if self.proc.wait() != 0:
+            raise RuntimeError("git fast-import failed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is not None:
+            # Do not finalize a partially written commit
+            self.proc.kill()
+            self.proc.wait()
+            return
+        self.close()
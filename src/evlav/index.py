@@ -1,12 +1,40 @@
+import hashlib
 import logging
 import os
-from datetime import datetime
+import re
+import sys
+import threading
+from array import array
+from datetime import datetime, timedelta
 from html.parser import HTMLParser
-from io import BufferedReader
+from http.client import HTTPException
 from typing import Literal, NamedTuple
 
+from .download import ConnectionPool, DownloadError
+from .metadata import MetadataStore, get_store
+from .trace import span
+
 logger = logging.getLogger(__name__)
 
+PARALLEL_INDEXES = 12
+# The table IndexParser reads and the start of each of its rows
+INDEX_TABLE = re.compile(
+    r"<table[^>]*\bid=\"(?:index|index-table|list)\"[^>]*>", re.IGNORECASE
+)
+INDEX_TABLE_END = re.compile(r"</table", re.IGNORECASE)
+INDEX_ROW = re.compile(r"(?=<tr[\s>])", re.IGNORECASE)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(date: datetime) -> int:
+    return (date - EPOCH) // timedelta(seconds=1)
+
+
+def from_epoch(ts: int) -> datetime:
+    return EPOCH + timedelta(seconds=ts)
+
 
 class Package(NamedTuple):
     name: str
@@ -15,11 +43,136 @@ class Package(NamedTuple):
     size: int
 
 
-class Update(NamedTuple):
-    date: datetime
-    size: int
-    packages: tuple[Package, ...]
-    prev: "Update | None" = None
+class PackageTable:
+    """Packages and update histories of all indexes, each stored once.
+
+    The trunk and branches of a repository list mostly the same packages, so
+    a package is kept in the columns once and referred to by its id. An update
+    is identified by its date, packages and previous update, which are interned
+    to an integer key. Updates with the same history share their key."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names: list[str] = []
+        # None if the link is the name
+        self.links: list[str | None] = []
+        self.dates = array("q")
+        self.sizes = array("q")
+        self.ids: dict[tuple[str, str, int, int], int] = {}
+        self.keys: dict[tuple[int, int, tuple[int, ...]], int] = {}
+
+    def add_package(self, pkg: Package, ts: int) -> int:
+        # ts is the date of the package in seconds since the epoch
+        key = (pkg.name, pkg.link, ts, pkg.size)
+        pid = self.ids.get(key)
+        if pid is None:
+            pid = self.ids[key] = len(self.names)
+            self.names.append(sys.intern(pkg.name))
+            self.links.append(None if pkg.link == pkg.name else pkg.link)
+            self.dates.append(ts)
+            self.sizes.append(pkg.size)
+        return pid
+
+    def get_package(self, pid: int) -> Package:
+        name = self.names[pid]
+        return Package(
+            name, self.links[pid] or name, from_epoch(self.dates[pid]), self.sizes[pid]
+        )
+
+    def update_key(self, prev: int, date: int, pids: tuple[int, ...]) -> int:
+        return self.keys.setdefault((prev, date, pids), len(self.keys) + 1)
+
+
+PACKAGES = PackageTable()
+
+
+class Update:
+    """View of an update of a timeline. Comparing updates compares their keys,
+    which is the same as comparing their whole histories."""
+
+    __slots__ = ("timeline", "id")
+
+    def __init__(self, timeline: "Timeline", id: int):
+        self.timeline = timeline
+        self.id = id
+
+    @property
+    def date(self) -> datetime:
+        return from_epoch(self.timeline.dates[self.id])
+
+    @property
+    def size(self) -> int:
+        return self.timeline.sizes[self.id]
+
+    @property
+    def packages(self) -> tuple[Package, ...]:
+        tl = self.timeline
+        pids = tl.packages[tl.starts[self.id] : tl.starts[self.id + 1]]
+        return tuple(tl.table.get_package(pid) for pid in pids)
+
+    @property
+    def prev(self) -> "Update | None":
+        return Update(self.timeline, self.id - 1) if self.id else None
+
+    @property
+    def key(self) -> int:
+        return self.timeline.keys[self.id]
+
+    def __eq__(self, other):
+        if not isinstance(other, Update):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"Update(date={self.date!r}, size={self.size}, id={self.id})"
+
+
+class Timeline:
+    """The updates of an index in date order, stored as columns."""
+
+    def __init__(self, table: PackageTable = PACKAGES):
+        self.table = table
+        self.dates = array("q")
+        self.sizes = array("q")
+        self.keys = array("q")
+        # The packages of update i are packages[starts[i]:starts[i + 1]]
+        self.starts = array("q", [0])
+        self.packages = array("q")
+        self._keys: set[int] | None = None
+
+    def append(self, date: datetime, packages: list[Package]):
+        # The packages of an update share its date
+        ts = to_epoch(date)
+        pids = tuple(self.table.add_package(pkg, ts) for pkg in packages)
+        prev = self.keys[-1] if self.keys else 0
+        self.keys.append(self.table.update_key(prev, ts, pids))
+        self.dates.append(ts)
+        self.sizes.append(sum(pkg.size for pkg in packages))
+        self.packages.extend(pids)
+        self.starts.append(len(self.packages))
+        self._keys = None
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, i: int) -> Update:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("timeline index out of range")
+        return Update(self, i)
+
+    def __iter__(self):
+        return (Update(self, i) for i in range(len(self)))
+
+    def __contains__(self, upd: Update) -> bool:
+        # Whether the update and its history are part of this timeline
+        if self._keys is None:
+            self._keys = set(self.keys)
+        return upd.key in self._keys
 
 
 class Repository(NamedTuple):
@@ -27,7 +180,11 @@ class Repository(NamedTuple):
     branch: str
     version: str
     url: str
-    latest: Update
+    timeline: Timeline
+
+    @property
+    def latest(self) -> Update:
+        return self.timeline[-1]
 
 
 class IndexParser(HTMLParser):
@@ -131,55 +288,184 @@ class IndexParser(HTMLParser):
                     pass
 
 
-def process_index(data: BufferedReader):
-    # Get the packages
+def split_index_rows(text: str) -> list[str] | None:
+    # Each chunk starts with a row, which IndexParser reads independently
+    # of the others. Returns None if the layout is not the expected one
+    table = INDEX_TABLE.search(text)
+    if not table or INDEX_TABLE.search(text, table.end()):
+        return None
+    end = INDEX_TABLE_END.search(text, table.end())
+    if not end:
+        return None
+    inner = text[table.end() : end.start()]
+
+    first, *rest = inner.split("<tr")
+    if any(chunk[:1] not in (" ", "\t", "\r", "\n", ">") for chunk in rest) or (
+        "<TR" in inner or "<Tr" in inner or "<tR" in inner
+    ):
+        return INDEX_ROW.split(inner)
+    return [first, *("<tr" + chunk for chunk in rest)]
+
+
+def _row_packages(rows: list[list]) -> list[Package]:
+    dates: dict[str, datetime] = {}
+    packages = []
+    for row in rows:
+        if len(row) == 1:
+            continue
+        _, name, link, date, size = row
+        if date not in dates:
+            dates[date] = datetime.fromisoformat(date)
+        packages.append(Package(name, link or name, dates[date], size))
+    return packages
+
+
+def parse_index(name: str, data: bytes, store: MetadataStore | None = None):
+    """Parses the packages of an index file. The rows are kept in the store,
+    so an unchanged index is not parsed at all and a changed one only has its
+    new rows parsed."""
+    digest = hashlib.sha256(data).hexdigest()
+    cached_digest, cached = store.get_index_rows(name) if store else (None, None)
+    if cached is not None and cached_digest == digest:
+        return _row_packages(cached)
+
+    text = data.decode("utf-8")
+    chunks = split_index_rows(text)
+    if chunks is None:
+        parser = IndexParser()
+        parser.feed(text)
+        return parser.packages
+
+    known = {row[0]: row for row in cached or []}
+    rows = []
+    parsed = 0
+    # A chunk has a single row, so it adds at most one package
     parser = IndexParser()
-    parser.feed(data.read().decode("utf-8"))
-    packages = parser.packages
+    parser.feed('<table id="list">')
+    for chunk in chunks:
+        key = hashlib.blake2b(chunk.encode(), digest_size=8).hexdigest()
+        row = known.get(key)
+        if row is None:
+            count = len(parser.packages)
+            parser.feed(chunk)
+            row = [key]
+            if len(parser.packages) > count:
+                pkg = parser.packages[-1]
+                link = "" if pkg.link == pkg.name else pkg.link
+                row = [key, pkg.name, link, pkg.date.isoformat(), pkg.size]
+            parsed += 1
+        rows.append(row)
+
+    if cached is not None:
+        logger.info(f"Parsed {parsed} new rows of index {name}")
+    if store:
+        store.put_index_rows(name, digest, rows)
+    return _row_packages(rows)
 
-    if not packages:
-        raise ValueError("No packages found in index")
+
+def build_timeline(packages: list[Package]) -> Timeline:
+    # Group packages by date in a single pass, keeping index order
+    groups: dict[datetime, list[Package]] = {}
+    for pkg in packages:
+        groups.setdefault(pkg.date, []).append(pkg)
 
     # Create a timeline, keep only date and skip hour
-    dates = sorted(set(pkg.date for pkg in packages))
-    timeline: list[Update] = []
-    prev_update = None
-    for date in dates:
-        pkgs = tuple(pkg for pkg in packages if pkg.date == date)
-        size = sum(pkg.size for pkg in pkgs)
-        prev_update = Update(date=date, size=size, packages=pkgs, prev=prev_update)
-        timeline.append(prev_update)
+    timeline = Timeline()
+    with timeline.table.lock:
+        for date in sorted(groups):
+            timeline.append(date, groups[date])
 
     return timeline
 
 
-def get_repos(
-    repo: str, versions: list[str], sources: str, cache: str, skip_existing: bool
-) -> list[Repository]:
-    repos = []
-
-    for v in versions:
-        fn = os.path.join(cache, f"{repo}-{v}.html")
-
-        if not skip_existing or not os.path.exists(fn):
-            url = f"{sources}/{repo}-{v}/"
-            logger.info(f"Downloading index for {repo}:{v} from {url}")
-            os.makedirs(cache, exist_ok=True)
-            os.system(f"curl -sSL {url} -o {fn}")
-        else:
-            logger.info(f"Using cached index for {repo}:{v}")
-
-        with open(fn, "rb") as f:
-            timeline = process_index(f)
-
-        repos.append(
-            Repository(
-                name=f"{repo}:{v}",
-                branch=repo,
-                version=v,
-                url=f"{sources}/{repo}-{v}/",
-                latest=timeline[-1],
-            )
-        )
+def fetch_index(pool: ConnectionPool, url: str, fn: str, store: MetadataStore):
+    # Only download the index if it changed since the last run
+    name = os.path.basename(fn)
+    headers = {}
+    if os.path.exists(fn):
+        etag, last_modified = store.get_index(name)
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    conn, resp, _ = pool.request(url, headers)
+    try:
+        if resp.status == 304:
+            resp.read()
+            return False
+        if resp.status != 200:
+            resp.read()
+            raise DownloadError(f"HTTP {resp.status} {resp.reason} for {url}")
+        data = resp.read()
+    finally:
+        pool.release(conn, resp)
+
+    with open(f"{fn}.tmp", "wb") as f:
+        f.write(data)
+    os.rename(f"{fn}.tmp", fn)
+    store.put_index(name, resp.getheader("ETag"), resp.getheader("Last-Modified"))
+    return True
+
+
+def get_repo(
+    repo: str,
+    v: str,
+    sources: str,
+    cache: str,
+    skip_existing: bool,
+    pool: ConnectionPool,
+) -> Repository:
+    fn = os.path.join(cache, f"{repo}-{v}.html")
+    url = f"{sources}/{repo}-{v}/"
+
+    if not skip_existing or not os.path.exists(fn):
+        try:
+            with span(f"{repo}-{v}", "index"):
+                changed = fetch_index(pool, url, fn, get_store(cache))
+            if changed:
+                logger.info(f"Downloaded index for {repo}:{v} from {url}")
+            else:
+                logger.info(f"Index for {repo}:{v} is unchanged")
+        except (OSError, HTTPException, DownloadError) as e:
+            if not os.path.exists(fn):
+                raise
+            logger.info(f"Failed to refresh index for {repo}:{v}, using cached: {e}")
+    else:
+        logger.info(f"Using cached index for {repo}:{v}")
+
+    with open(fn, "rb") as f:
+        packages = parse_index(f"{repo}-{v}", f.read(), get_store(cache))
+    if not packages:
+        raise ValueError(f"No packages found in index {repo}-{v}")
+    timeline = build_timeline(packages)
+
+    return Repository(
+        name=f"{repo}:{v}",
+        branch=repo,
+        version=v,
+        url=url,
+        timeline=timeline,
+    )
+
+
+def get_all_repos(
+    repos: list[str],
+    versions: list[str],
+    sources: str,
+    cache: str,
+    skip_existing: bool,
+) -> dict[str, list[Repository]]:
+    # Fetch and parse the indexes of all repos and versions concurrently
+    from concurrent.futures import ThreadPoolExecutor
 
-    return repos
+    os.makedirs(cache, exist_ok=True)
+    with ConnectionPool() as pool, ThreadPoolExecutor(PARALLEL_INDEXES) as ex:
+        futures = {
+            r: [
+                ex.submit(get_repo, r, v, sources, cache, skip_existing, pool)
+                for v in versions
+            ]
+            for r in repos
+        }
+        return {r: [f.result() for f in fs] for r, fs in futures.items()}
@@ -0,0 +1,269 @@
+import json
+import logging
+import os
+import sqlite3
+import tarfile
+import threading
+from typing import Any, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+METADATA_FN = "metadata.sqlite"
+# Bump when the parsing in parse_pkgbuild or IndexParser or the blob keys change
+# to invalidate the store
+METADATA_VERSION = 2
+
+
+class Member(NamedTuple):
+    name: str
+    type: str
+    mode: int
+    size: int
+    mtime: int
+    chksum: int
+    linkname: str
+    offset_data: int
+
+
+def get_member_info(ti: tarfile.TarInfo) -> Member:
+    return Member(
+        name=ti.name,
+        type=ti.type.decode(),
+        mode=ti.mode,
+        size=ti.size,
+        mtime=int(ti.mtime),
+        chksum=ti.chksum,
+        linkname=ti.linkname,
+        offset_data=ti.offset_data,
+    )
+
+
+def read_members(archive: str, members: list[Member]) -> list[bytes]:
+    # Read the data of regular members at their offsets from the cached
+    # member list, in a single forward pass that stops after the last one.
+    # tarfile.getmember would decompress the whole archive just to find them
+    import gzip
+
+    data = [b""] * len(members)
+    last = None
+    with gzip.open(archive, "rb") as f:
+        for i in sorted(range(len(members)), key=lambda i: members[i].offset_data):
+            member = members[i]
+            if last and last[0] == member.offset_data:
+                # Hard links to the same member, seeking back would restart
+                data[i] = last[1]
+                continue
+            f.seek(member.offset_data)
+            data[i] = f.read(member.size)
+            if len(data[i]) != member.size:
+                raise EOFError(f"Archive {archive} ended while reading {member.name}")
+            last = (member.offset_data, data[i])
+    return data
+
+
+class MetadataStore:
+    """Persists the parsed metadata of each source package in the cache.
+
+    Entries are keyed by the archive name, size and mtime, so replaced
+    archives are parsed again."""
+
+    def __init__(self, cache: str):
+        os.makedirs(cache, exist_ok=True)
+        self.fn = os.path.join(cache, METADATA_FN)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.fn, check_same_thread=False, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Losing the last entries on power loss is fine for a cache
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version != METADATA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS sources")
+            self.db.execute("DROP TABLE IF EXISTS index_rows")
+            self.db.execute("DROP TABLE IF EXISTS blobs")
+            self.db.execute(f"PRAGMA user_version={METADATA_VERSION}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sources "
+            "(name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, data TEXT)"
+        )
+        # Validators of the downloaded index files for conditional requests
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS indexes "
+            "(name TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)"
+        )
+        # Git blob hash of archive members by archive and member name
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (key TEXT PRIMARY KEY, sha TEXT)"
+        )
+        # Parsed rows of each index file, by the digest of its contents
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS index_rows "
+            "(name TEXT PRIMARY KEY, digest TEXT, data TEXT)"
+        )
+        # Archives that passed `evlav verify`
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS verified "
+            "(name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)"
+        )
+        # Refs of the archive each internal repo was last pushed from, by url
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pushed (url TEXT PRIMARY KEY, refs TEXT)"
+        )
+        # Update name to commit map of each remote repository, with the branch
+        # tips it was read at
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tags (repo TEXT PRIMARY KEY, tips TEXT, data TEXT)"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def _key(fn: str) -> tuple[int, int]:
+        st = os.stat(fn)
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, fn: str) -> dict[str, Any] | None:
+        size, mtime = self._key(fn)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime, data FROM sources WHERE name = ?",
+                (os.path.basename(fn),),
+            ).fetchone()
+        if not row or row[0] != size or row[1] != mtime:
+            return None
+        return json.loads(row[2])
+
+    def put(self, fn: str, data: dict[str, Any]):
+        size, mtime = self._key(fn)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                (os.path.basename(fn), size, mtime, json.dumps(data)),
+            )
+            self.db.commit()
+
+    def get_index(self, name: str) -> tuple[str | None, str | None]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag, last_modified FROM indexes WHERE name = ?", (name,)
+            ).fetchone()
+        return (row[0], row[1]) if row else (None, None)
+
+    def put_index(self, name: str, etag: str | None, last_modified: str | None):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO indexes VALUES (?, ?, ?)",
+                (name, etag, last_modified),
+            )
+            self.db.commit()
+
+    def get_index_rows(self, name: str) -> tuple[str | None, list[list] | None]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT digest, data FROM index_rows WHERE name = ?", (name,)
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row else (None, None)
+
+    def put_index_rows(self, name: str, digest: str, rows: list[list]):
+        data = json.dumps(rows, separators=(",", ":"))
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO index_rows VALUES (?, ?, ?)",
+                (name, digest, data),
+            )
+            self.db.commit()
+
+    @classmethod
+    def _blob_key(cls, fn: str, member: Member) -> str:
+        # The tar header checksum does not cover the contents, so members are
+        # only identified within the archive they were read from
+        size, mtime = cls._key(fn)
+        return f"{os.path.basename(fn)}:{size}:{mtime}:{member.name}"
+
+    def get_blob(self, fn: str, member: Member) -> str | None:
+        key = self._blob_key(fn, member)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sha FROM blobs WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_blob(self, fn: str, member: Member, sha: str):
+        key = self._blob_key(fn, member)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)", (key, sha))
+            self.db.commit()
+
+    def is_verified(self, name: str, size: int, mtime: int) -> bool:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime FROM verified WHERE name = ?", (name,)
+            ).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime
+
+    def put_verified(self, name: str, size: int, mtime: int, digest: str):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?)",
+                (name, size, mtime, digest),
+            )
+            self.db.commit()
+
+    def remove_verified(self, name: str):
+        with self.lock:
+            self.db.execute("DELETE FROM verified WHERE name = ?", (name,))
+            self.db.commit()
+
+    def get_pushed(self, url: str) -> dict[str, str] | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT refs FROM pushed WHERE url = ?", (url,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_pushed(self, url: str, refs: dict[str, str]):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pushed VALUES (?, ?)",
+                (url, json.dumps(refs, sort_keys=True)),
+            )
+            self.db.commit()
+
+    def get_tags(
+        self, repo: str
+    ) -> tuple[dict[str, str] | None, dict[str, str] | None]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT tips, data FROM tags WHERE repo = ?", (repo,)
+            ).fetchone()
+        return (json.loads(row[0]), json.loads(row[1])) if row else (None, None)
+
+    def put_tags(self, repo: str, tips: dict[str, str], tags: dict[str, str]):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO tags VALUES (?, ?, ?)",
+                (repo, json.dumps(tips), json.dumps(tags, separators=(",", ":"))),
+            )
+            self.db.commit()
+
+
+_stores: dict[str, MetadataStore] = {}
+_stores_lock = threading.Lock()
+
+
+def _reset_stores():
+    # sqlite connections must not be used across a fork, forked processes
+    # open their own
+    global _stores_lock
+    _stores.clear()
+    _stores_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_stores)
+
+
+def get_store(cache: str) -> MetadataStore:
+    key = os.path.abspath(cache)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = MetadataStore(cache)
+        return _stores[key]
@@ -0,0 +1,232 @@
+import logging
+import os
+import shutil
+import tarfile
+
+from .metadata import Member, read_members
+from .trace import run_cmd
+
+logger = logging.getLogger(__name__)
+
+MIRRORS_DIR = "mirrors"
+# Files of a pack that are copied, the index last, as it makes the pack visible
+PACK_EXTS = (".pack", ".rev", ".idx")
+
+
+def _git(git_dir: str, *args: str, input: str | None = None) -> str:
+    out = run_cmd(
+        ["git", "--git-dir", git_dir, *args],
+        input=input,
+        capture_output=True,
+        text=True,
+    )
+    if out.returncode != 0:
+        raise RuntimeError(f"git {args[0]} failed in {git_dir}: {out.stderr.strip()}")
+    return out.stdout
+
+
+def get_mirror_path(cache: str, repo_name: str) -> str:
+    return os.path.join(cache, MIRRORS_DIR, f"{repo_name}.git")
+
+
+def open_mirror(git_dir: str) -> str:
+    if not os.path.exists(os.path.join(git_dir, "objects")):
+        os.makedirs(git_dir, exist_ok=True)
+        _git(git_dir, "init", "--bare", "-q")
+    return git_dir
+
+
+def parse_refs(packed_refs: str | None, loose_refs: dict[str, str]) -> dict[str, str]:
+    # Loose refs take precedence over packed ones, symbolic refs are skipped
+    refs = {}
+    for line in (packed_refs or "").splitlines():
+        if not line or line[0] in "#^":
+            continue
+        sha, _, ref = line.partition(" ")
+        refs[ref] = sha
+    for ref, content in loose_refs.items():
+        content = content.strip()
+        if content and not content.startswith("ref:"):
+            refs[ref] = content
+    return refs
+
+
+def read_archive_refs(
+    archive: str, prefix: str, members: list[Member]
+) -> dict[str, str] | None:
+    # Reads only the ref files of the repository under `prefix`, at their
+    # offsets from the cached member list. Returns None if the refs cannot be
+    # read this way
+    wanted = []
+    for m in members:
+        if not m.name.startswith(prefix):
+            continue
+        path = m.name[len(prefix) :]
+        if path != "packed-refs" and not path.startswith("refs/"):
+            continue
+        if m.type == tarfile.DIRTYPE.decode():
+            continue
+        if m.type not in (tarfile.REGTYPE.decode(), tarfile.AREGTYPE.decode()):
+            return None
+        wanted.append(m)
+
+    packed_refs = None
+    loose_refs = {}
+    for m, data in zip(wanted, read_members(archive, wanted)):
+        path = m.name[len(prefix) :]
+        if path == "packed-refs":
+            packed_refs = data.decode()
+        else:
+            loose_refs[path] = data.decode()
+    return parse_refs(packed_refs, loose_refs)
+
+
+def get_refs(git_dir: str) -> dict[str, str]:
+    out = _git(git_dir, "for-each-ref", "--format=%(objectname) %(refname)")
+    refs = {}
+    for line in out.splitlines():
+        sha, _, ref = line.partition(" ")
+        refs[ref] = sha
+    return refs
+
+
+def set_refs(git_dir: str, refs: dict[str, str]):
+    # Makes the refs of the mirror equal to refs in a single transaction
+    current = get_refs(git_dir)
+    cmds = [
+        f"update {ref} {sha}" for ref, sha in refs.items() if current.get(ref) != sha
+    ]
+    cmds += [f"delete {ref}" for ref in current if ref not in refs]
+    if cmds:
+        _git(git_dir, "update-ref", "--stdin", input="\n".join(cmds) + "\n")
+
+
+def import_repo(archive: str, prefix: str, git_dir: str) -> dict[str, str]:
+    """Copies the git repository under `prefix` in the archive into the bare
+    mirror at `git_dir` with a single pass over the archive. Packs are named by
+    their contents, so only packs and loose objects the mirror does not have
+    are written. The refs of the mirror are then set to the ones of the
+    archive, which are returned, and the packs the archive no longer has are
+    removed. Raises RuntimeError if the archive has no repository under
+    `prefix`, as the empty refs would delete every ref of the mirror."""
+    open_mirror(git_dir)
+    objects = os.path.join(git_dir, "objects")
+
+    packed_refs = None
+    loose_refs = {}
+    shallow = None
+    packs = []
+    stems = set()
+    has_objects = False
+    written = 0
+    with tarfile.open(archive, "r|gz") as tar:
+        for ti in tar:
+            if not ti.name.startswith(prefix):
+                continue
+            path = ti.name[len(prefix) :]
+            if ti.isdir():
+                continue
+            if not ti.isfile():
+                raise RuntimeError(f"Unsupported member '{ti.name}' in repository")
+
+            if path == "packed-refs" or path == "shallow" or path.startswith("refs/"):
+                with tar.extractfile(ti) as f:
+                    data = f.read().decode()
+                if path == "packed-refs":
+                    packed_refs = data
+                elif path == "shallow":
+                    shallow = data
+                else:
+                    loose_refs[path] = data
+                continue
+
+            if not path.startswith("objects/"):
+                continue
+            rest = path[len("objects/") :]
+            if rest.startswith("pack/"):
+                if not rest.endswith(PACK_EXTS):
+                    continue
+                stem = rest.rsplit(".", 1)[0]
+                stems.add(stem)
+                has_objects = True
+                if os.path.exists(os.path.join(objects, stem + ".idx")):
+                    continue
+                packs.append(rest)
+                # Renamed once all files of the pack are written
+                tmp = os.path.join(objects, rest + ".tmp")
+                dest = None
+            elif rest[2:3] == "/" and len(rest) in (41, 65):
+                has_objects = True
+                dest = os.path.join(objects, rest)
+                if os.path.exists(dest):
+                    continue
+                tmp = dest + ".tmp"
+            else:
+                continue
+
+            os.makedirs(os.path.dirname(tmp), exist_ok=True)
+            with tar.extractfile(ti) as src, open(tmp, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024**2)
+            if dest:
+                os.rename(tmp, dest)
+            written += ti.size
+
+    refs = parse_refs(packed_refs, loose_refs)
+    if not refs or not has_objects:
+        for rest in packs:
+            os.remove(os.path.join(objects, rest + ".tmp"))
+        raise RuntimeError(f"No git repository under '{prefix}' in {archive}")
+
+    # Git only looks at packs that have an index
+    for ext in PACK_EXTS:
+        for rest in packs:
+            if rest.endswith(ext):
+                os.rename(
+                    os.path.join(objects, rest + ".tmp"), os.path.join(objects, rest)
+                )
+
+    shallow_fn = os.path.join(git_dir, "shallow")
+    if shallow:
+        with open(shallow_fn, "w") as f:
+            f.write(shallow)
+    elif os.path.exists(shallow_fn):
+        os.remove(shallow_fn)
+
+    set_refs(git_dir, refs)
+    removed = remove_stale_packs(git_dir, stems)
+    logger.info(
+        f"Imported {len(packs)} pack files and {written / 1024**2:.1f} MiB into "
+        f"{os.path.basename(git_dir)}, removed {removed} old packs"
+    )
+    return refs
+
+
+def remove_stale_packs(git_dir: str, stems: set[str]) -> int:
+    # Upstream gc rewrites the repository into new packs, so the packs of
+    # older archives would pile up in the mirror. The archive has all objects
+    # of its refs, so the packs it does not have can go
+    pack_dir = os.path.join(git_dir, "objects", "pack")
+    stale = set()
+    for fn in os.listdir(pack_dir):
+        stem = fn.split(".", 1)[0]
+        if fn.startswith("pack-") and f"pack/{stem}" not in stems:
+            stale.add(stem)
+    for stem in stale:
+        # The index first, as it makes the pack visible
+        for ext in reversed(PACK_EXTS):
+            fn = os.path.join(pack_dir, stem + ext)
+            if os.path.exists(fn):
+                os.remove(fn)
+        for fn in os.listdir(pack_dir):
+            if fn.split(".", 1)[0] == stem:
+                os.remove(os.path.join(pack_dir, fn))
+    if stale:
+        # Loose objects that are now in the packs of the archive
+        _git(git_dir, "prune-packed", "-q")
+    return len(stale)
+
+
+def fetch_repo(repo_dir: str, git_dir: str):
+    # Fallback for repositories import_repo cannot read, from an extracted copy
+    open_mirror(git_dir)
+    _git(git_dir, "fetch", "-q", "--prune", "--force", repo_dir, "+refs/*:refs/*")
@@ -4,15 +4,40 @@ import re
 import shlex
 import shutil
 import tarfile
-from typing import NamedTuple
+import threading
+from contextlib import AbstractContextManager, closing, nullcontext
+from typing import Callable, NamedTuple
 
+from .download import ConnectionPool, download
+from .fastimport import MODE_EXEC, MODE_FILE, MODE_LINK, REF_PREFIX, FastImport
 from .index import Repository, Update
+from .metadata import Member, get_member_info, get_store, read_members
+from .mirror import (
+    fetch_repo,
+    get_mirror_path,
+    get_refs,
+    import_repo,
+    read_archive_refs,
+)
+from .trace import run_cmd, span
+from .tree import TreeCache, blob_hash, join_path
 
 logger = logging.getLogger(__name__)
 
 INTERNAL_CHECK = "steamos.cloud"
 PARALLEL_PULLS = 8
+PARALLEL_PUSHES = 4
+# Maintenance branches to process at the same time, each in its own worktree
+PARALLEL_VERSIONS = 1
 MAX_SUBJ_PACKAGES = 9
+# Updates to decompress ahead of the one being committed
+LOOKAHEAD = 4
+LOOKAHEAD_MEMORY = 1024**3
+# Larger files seen before the PKGBUILD of an archive are read later by offset
+PENDING_SIZE = 1024**2
+# Push once this many bytes of archives were committed or seconds passed
+PUSH_BYTES = 512 * 1024**2
+PUSH_SECONDS = 600
 
 INTERNAL_REPLACE = [
     r"ssh:\/\/git@gitlab.internal.steamos.cloud:?\/[a-z0-9_-]+",
@@ -34,9 +59,7 @@ def run(
     env: dict[str, str] | None = None,
     error: bool = True,
 ):
-    import subprocess
-
-    result = subprocess.run(cmd, env=env)
+    result = run_cmd(cmd, env=env)
     if result.returncode != 0:
         if error:
             raise RuntimeError(f"Command {' '.join(cmd)} failed")
@@ -48,9 +71,7 @@ def srun(
     error: bool = True,
     silent: bool = False,
 ) -> str:
-    import subprocess
-
-    result = subprocess.run(cmd, capture_output=True, text=True, env=env)
+    result = run_cmd(cmd, capture_output=True, text=True, env=env)
     if result.returncode != 0:
         if not silent:
             logger.info(f"Command failed with code {result.returncode}")
@@ -87,33 +108,10 @@ def infer_version(fn: str) -> str:
     return suffix
 
 
-def extract_sources(fn, tar) -> Sources | None:
-    # File is a .tar.gz archive containing a 'PKGBUILD' file
+def parse_pkgbuild(pkgname: str, pkgver: str, pkgbuild: str) -> Sources:
     # The PKGBUILD is a bash script that contains a sources variable
     # The sources variable consists of files (protocol file://) and
     # repos. For repos, we only care to preserve steamos ones
-
-    # Try to infer package name from fn, otherwise find first dir
-    # Structure of name is <name>-<version>-<release>.src.tar.gz
-    # Example: jupiter-3.7.0-1.src.tar.gz
-    pkgname = infer_name(fn)
-    pkgver = infer_version(fn)
-
-    if not pkgname:
-        logger.info(f"Could not infer package name from filename {fn}")
-        files = tar.getnames()
-        if not files:
-            logger.info(f"No files found in archive {fn}")
-            return None
-
-        pkgname = files[0].split("/")[0]
-
-    pkgbuild = tar.extractfile(f"{pkgname}/PKGBUILD")
-    if not pkgbuild:
-        logger.info(f"No PKGBUILD found in archive {fn}")
-        return None
-
-    pkgbuild = pkgbuild.read().decode("utf-8")
     sources = []
     matches = re.findall(
         r"^ *(?:source|install) *= *(\(.*?(?:\(.*?\).*?)?\)|(?!\().*?$)",
@@ -224,17 +222,214 @@ def extract_sources(fn, tar) -> Sources | None:
     return Sources(pkgname, files=files, repos=repos, pkgbuild=pkgbuild)
 
 
-def prepare_repo(repo: str, work: str, remote: str, name: str, email: str):
+def stream_sources(
+    cache: str, name: str
+) -> tuple[Sources | None, list[Member], dict[str, tuple[int, bytes]]]:
+    """Reads the sources and member list of an archive in a single pass over
+    its gzip stream. The PKGBUILD is parsed when it is reached, and the files
+    it lists are read as they pass by, the small ones before it are kept until
+    it is known. Returns the contents of the listed files, which may miss files
+    that are not regular, are in a subdirectory or were too large to keep."""
+    fn = os.path.join(cache, name)
+    store = get_store(cache)
+    # Try to infer package name from fn, otherwise find first dir
+    # Structure of name is <name>-<version>-<release>.src.tar.gz
+    # Example: jupiter-3.7.0-1.src.tar.gz
+    pkgname = infer_name(name)
+    pkgver = infer_version(name)
+    if not pkgname:
+        logger.info(f"Could not infer package name from filename {name}")
+
+    src = None
+    members = []
+    # Files at the top of the package seen before the PKGBUILD
+    pending: dict[str, tuple[int, bytes]] = {}
+    wanted: set[str] = set()
+    files = {}
+    with tarfile.open(fn, "r|gz") as tar:
+        for ti in tar:
+            members.append(get_member_info(ti))
+            if not pkgname:
+                pkgname = ti.name.split("/")[0]
+            if not ti.isfile() or not ti.name.startswith(f"{pkgname}/"):
+                continue
+            path = ti.name[len(pkgname) + 1 :]
+
+            if src is None and path == "PKGBUILD":
+                with tar.extractfile(ti) as f:
+                    src = parse_pkgbuild(pkgname, pkgver, f.read().decode("utf-8"))
+                wanted = set(get_member_names(src))
+                for seen, blob in pending.items():
+                    if seen in wanted:
+                        files[seen] = blob
+                pending.clear()
+                continue
+
+            if src is None and ("/" in path or ti.size > PENDING_SIZE):
+                continue
+            if src is not None and path not in wanted:
+                continue
+            with tar.extractfile(ti) as f:
+                data = f.read()
+            mode = MODE_EXEC if ti.mode & 0o100 else MODE_FILE
+            if src is None:
+                pending[path] = (mode, data)
+            else:
+                files[path] = (mode, data)
+
+    if src is None:
+        logger.info(f"No PKGBUILD found in archive {fn}")
+    store.put(
+        fn,
+        {"sources": src._asdict() if src else None, "members": members},
+    )
+    return src, members, files
+
+
+def load_sources(
+    cache: str, name: str
+) -> tuple[Sources | None, list[Member], dict[str, tuple[int, bytes]]]:
+    # Finding the PKGBUILD decompresses the whole archive, so the parsed
+    # sources and member list are kept in the cache metadata store. The
+    # archive is only read when it is not there, which also returns the files
+    # of the package that were read along the way
+    fn = os.path.join(cache, name)
+    data = get_store(cache).get(fn)
+    if data is None:
+        return stream_sources(cache, name)
+
+    members = [Member(*m) for m in data["members"]]
+    if not data["sources"]:
+        return None, members, {}
+    src = Sources(**data["sources"])
+    return src._replace(repos=[tuple(r) for r in src.repos]), members, {}
+
+
+def rewrite_pkgbuild(pkgbuild: str, pull_remote: str | None) -> str:
+    if pull_remote:
+        for pattern in INTERNAL_REPLACE:
+            pkgbuild = re.sub(pattern, pull_remote, pkgbuild)
+    return pkgbuild
+
+
+def get_member_names(src: Sources) -> list[str]:
+    names = []
+    for fn in src.files:
+        # cleanup fn
+        if "libssh2" in src.pkg:
+            # _name=${pkgname#lib32-}
+            # $_name-1.11.1-CVE-2026-55200.patch
+            fn = fn.replace("$_name", "libssh2")
+        names.append(fn)
+    return names
+
+
+def get_members(
+    tar: tarfile.TarFile, src: Sources, names: list[str] | None = None
+) -> list[tarfile.TarInfo]:
+    members = []
+    for fn in get_member_names(src) if names is None else names:
+        member = tar.getmember(f"{src.pkg}/{fn}")
+        member.name = fn  # Prevent path traversal
+        members.append(member)
+    return members
+
+
+def read_member(
+    tar: tarfile.TarFile, member: tarfile.TarInfo
+) -> tuple[int, bytes] | None:
+    # Returns the git mode and contents of a member, None for directories
+    if member.issym():
+        return MODE_LINK, member.linkname.encode()
+    if member.isdir():
+        return None
+    f = tar.extractfile(member)
+    if not f:
+        return None
+    return MODE_EXEC if member.mode & 0o100 else MODE_FILE, f.read()
+
+
+def write_file(fn: str, mode: int, data: bytes):
+    # Replace what is there, without writing through an existing symlink
+    if os.path.islink(fn) or os.path.isfile(fn):
+        os.remove(fn)
+    elif os.path.isdir(fn):
+        shutil.rmtree(fn)
+    else:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+    if mode == MODE_LINK:
+        os.symlink(data.decode(), fn)
+        return
+    with open(fn, "wb") as f:
+        f.write(data)
+    os.chmod(fn, 0o755 if mode == MODE_EXEC else 0o644)
+
+
+def reset_clone(repo_path: str, url: str) -> bool:
+    # Brings a clone from a previous run to the state of a fresh one, with the
+    # remote branches fetched, the default branch checked out and no other
+    # local branches. Returns False if it cannot be reused
+    if not os.path.isdir(os.path.join(repo_path, ".git")):
+        return False
+    git = ["git", "-C", repo_path]
+    try:
+        if srun(git + ["remote", "get-url", "origin"], silent=True) != url:
+            return False
+        srun(git + ["worktree", "prune"])
+        srun(git + ["fetch", "--prune", "origin"])
+
+        refs = srun(
+            git + ["for-each-ref", "--format=%(refname)", "refs/heads", REF_PREFIX]
+        )
+        for ref in refs.splitlines():
+            srun(git + ["update-ref", "-d", ref])
+
+        # E.g., 'ref: refs/heads/main\tHEAD', nothing if the remote HEAD is unborn
+        out = srun(git + ["ls-remote", "--symref", "origin", "HEAD"])
+        head = None
+        for line in out.splitlines():
+            if line.startswith("ref: refs/heads/"):
+                head = line[len("ref: refs/heads/") :].split("\t", 1)[0]
+        if head and srun(
+            git + ["for-each-ref", f"refs/remotes/origin/{head}"], silent=True
+        ):
+            srun(git + ["checkout", "-q", "-f", "-B", head, f"origin/{head}"])
+        else:
+            # Like a fresh clone, nothing is checked out
+            srun(git + ["symbolic-ref", "HEAD", f"refs/heads/{head or 'master'}"])
+            srun(git + ["read-tree", "--empty"])
+        srun(git + ["clean", "-q", "-ffdx"])
+    except RuntimeError:
+        return False
+    return True
+
+
+def prepare_repo(
+    repo: str,
+    work: str,
+    remote: str,
+    name: str,
+    email: str,
+    reuse: bool = True,
+    clone_filter: str | None = None,
+):
     import shutil
 
     if not os.path.exists(work):
         os.makedirs(work, exist_ok=True)
 
     repo_path = f"{work}/{repo}"
-    if os.path.exists(repo_path):
-        shutil.rmtree(repo_path)
-
-    srun(["git", "clone", f"{remote}/{repo}", repo_path])
+    url = f"{remote}/{repo}"
+    if reuse and reset_clone(repo_path, url):
+        logger.info(f"Reusing the clone of {repo} in {repo_path}")
+    else:
+        if os.path.exists(repo_path):
+            shutil.rmtree(repo_path)
+        cmd = ["git", "clone", url, repo_path]
+        if clone_filter:
+            cmd.append(f"--filter={clone_filter}")
+        srun(cmd)
     srun(["git", "-C", repo_path, "config", "user.name", name])
     srun(["git", "-C", repo_path, "config", "user.email", email])
     srun(["git", "-C", repo_path, "config", "commit.gpgsign", "false"])
@@ -247,35 +442,86 @@ def get_name_from_update(repo: Repository, update: Update) -> str:
     return f"{repo.version}-{date_str}"
 
 
-def get_tags(repo_path: str, versions: list[str]) -> dict[str, str]:
-    logger.info("Extracting versions from git...")
-    tags = []
-    for v in versions:
-        try:
-            out = (
-                srun(
-                    [
-                        "git",
-                        "-C",
-                        repo_path,
-                        "log",
-                        "origin/" + v,
-                        "--format=%H:%ad:%s",
-                        "--date=format:%y%m%d-%H%MZ",
-                    ]
-                )
-                .strip()
-                .split("\n")
-            )
-            tags.extend(out)
-        except RuntimeError:
-            pass
+def get_branch_tips(repo_path: str, versions: list[str]) -> dict[str, str]:
+    out = srun(
+        [
+            "git",
+            "-C",
+            repo_path,
+            "for-each-ref",
+            "--format=%(refname:lstrip=3) %(objectname)",
+            *(f"refs/remotes/origin/{v}" for v in versions),
+        ]
+    )
+    return dict(line.split(" ", 1) for line in out.splitlines())
+
+
+def is_ancestor(repo_path: str, commit: str, tip: str) -> bool:
+    cmd = ["git", "-C", repo_path, "merge-base", "--is-ancestor", commit, tip]
+    return run_cmd(cmd, capture_output=True).returncode == 0
+
+
+def log_tags(repo_path: str, revs: list[str]) -> dict[str, str]:
+    out = srun(
+        [
+            "git",
+            "-C",
+            repo_path,
+            "log",
+            *revs,
+            "--format=%H:%ad:%s",
+            "--date=format:%y%m%d-%H%MZ",
+        ]
+    )
 
     mapping = {}
-    for t in tags:
+    for t in out.split("\n"):
+        if not t:
+            continue
         ghash, date, version, *_ = t.split(":", 3)
         mapping[version + "-" + date] = ghash.strip('"')
+    return mapping
+
+
+def get_tags(
+    repo_path: str,
+    versions: list[str],
+    cache: str | None = None,
+    key: str | None = None,
+) -> dict[str, str]:
+    """Maps the update names to the commits of the branches of `versions`.
+    With a cache, the map is kept in its metadata store under `key` with the
+    branch tips it was read at. If the tips did not change it is reused, and
+    if they only moved forward, only the new commits are read."""
+    tips = get_branch_tips(repo_path, versions)
+    store = get_store(cache) if cache and key else None
+
+    old_tips, mapping = store.get_tags(key) if store else (None, None)
+    if old_tips is not None and mapping is not None:
+        changed = {v: tip for v, tip in tips.items() if old_tips.get(v) != tip}
+        if set(old_tips) - set(tips) or any(
+            v in old_tips and not is_ancestor(repo_path, old_tips[v], tip)
+            for v, tip in changed.items()
+        ):
+            # A branch was removed or rewritten
+            mapping = None
+        elif changed:
+            logger.info(f"Reading new commits of {', '.join(changed)} from git...")
+            revs = list(changed.values())
+            revs += [f"^{old_tips[v]}" for v in changed if v in old_tips]
+            mapping.update(log_tags(repo_path, revs))
+        else:
+            logger.info(f"Branches unchanged, reusing {len(mapping)} versions")
 
+    if mapping is None:
+        logger.info("Extracting versions from git...")
+        mapping = {}
+        for v in versions:
+            if v in tips:
+                mapping.update(log_tags(repo_path, ["origin/" + v]))
+
+    if store:
+        store.put_tags(key, tips, mapping)
     return mapping
 
 
@@ -293,16 +539,10 @@ def get_upd_todo(
         prev_branch = branch
         should_break = False
 
-        # Create fork tag
-        if trunk and curr.prev:
-            cprev = curr.prev
-            chk = trunk.latest
-            while chk:
-                if chk == cprev:
-                    prev_branch = trunk
-                    should_break = True
-                    break
-                chk = chk.prev
+        # Create fork tag, equal updates have the same history
+        if trunk and curr.prev and curr.prev in trunk.timeline:
+            prev_branch = trunk
+            should_break = True
 
         begin_tag = get_name_from_update(prev_branch, curr.prev) if curr.prev else None
         todo.append((curr, begin_tag))
@@ -314,68 +554,137 @@ def get_upd_todo(
     return todo
 
 
-def download_missing(missing: dict[str, str]):
-    if not missing:
-        return
-
-    logger.info(f"Downloading {len(missing)} missing files...")
-
-    import queue
-    import threading
-    import time
-
-    broke = threading.Event()
-
-    def worker(q: queue.Queue):
-        while not broke.is_set():
-            fn = None
-            url = None
-            while fn is None and url is None and not broke.is_set():
-                try:
-                    fn, url = q.get(timeout=0.2)
-                except queue.Empty:
-                    pass
-            if fn is None or url is None or broke.is_set():
+def get_plans(
+    pairs: list[tuple[Repository, Repository | None, dict[str, str]]],
+) -> dict[str, list[tuple[Update, str | None]]]:
+    # The plans only depend on the tags of their own version, so they can
+    # be computed once and shared by find_and_push_latest and process_repo
+    return {
+        repo.name: get_upd_todo(tags, repo.latest, repo, trunk)
+        for repo, trunk, tags in pairs
+    }
+
+
+class DownloadQueue:
+    """Downloads archives in worker threads, in the order they are given.
+    Callers can use each archive as soon as it is on disk with `wait`, while
+    the ones after it are still downloading."""
+
+    def __init__(
+        self,
+        missing: dict[str, str],
+        sizes: dict[str, int] | None = None,
+        threads: int = PARALLEL_PULLS,
+        largest_first: bool = False,
+    ):
+        import queue
+
+        self.sizes = sizes or {}
+        self.done = {fn: threading.Event() for fn in missing}
+        self.failed: dict[str, str] = {}
+        self.broke = threading.Event()
+        self.queue = queue.Queue()
+        items = list(missing.items())
+        if largest_first:
+            # So the largest archives do not end up as the tail of the run
+            items.sort(key=lambda item: self.sizes.get(item[0]) or 0, reverse=True)
+        for fn, url in items:
+            self.queue.put((fn, url))
+        self.pool = ConnectionPool()
+        self.threads = [
+            threading.Thread(target=self._worker, name=f"download-{i}")
+            for i in range(min(threads, len(missing)))
+        ]
+        for t in self.threads:
+            t.start()
+
+    def _worker(self):
+        import queue
+
+        while not self.broke.is_set():
+            try:
+                fn, url = self.queue.get_nowait()
+            except queue.Empty:
                 break
             os.makedirs(os.path.dirname(fn), exist_ok=True)
             name = fn.rsplit("/", 1)[-1]
             try:
-                srun(["curl", "-sSL", url, "-o", f"{fn}.tmp"])
-                os.rename(f"{fn}.tmp", fn)
+                # Resumes from fn.tmp and retries with backoff
+                with span(name, "download") as sp:
+                    download(self.pool, url, fn, self.sizes.get(fn), cancel=self.broke)
+                    sp.set(bytes=os.path.getsize(fn))
             except Exception as e:
                 logger.info(f"Failed to download {name}: {e}")
-                broke.set()
-                break
+                self.failed[fn] = str(e)
+            else:
+                logger.info(f"Downloaded '{name}'")
+            finally:
+                self.done[fn].set()
+
+    def wait(self, fns: list[str], cancel: threading.Event | None = None):
+        # Blocks until the given archives are downloaded, archives that are
+        # not in the queue are skipped. Raises once cancel is set
+        for fn in fns:
+            if fn in self.done:
+                while not self.done[fn].wait(0.1 if cancel else None):
+                    if cancel.is_set():
+                        raise RuntimeError("Cancelled while waiting for downloads")
+            if fn in self.failed:
+                raise RuntimeError(
+                    f"Failed to download {os.path.basename(fn)}: {self.failed[fn]}"
+                )
 
-            logger.info(f"Downloaded '{name}'")
-            q.task_done()
+    def join(self):
+        for t in self.threads:
+            t.join()
+        if self.failed:
+            names = [os.path.basename(fn) for fn in self.failed]
+            raise RuntimeError(f"Failed to download {len(names)} files: {names}")
 
-    q = queue.Queue()
-    num_threads = min(PARALLEL_PULLS, len(missing))
-    threads = []
-    for _ in range(num_threads):
-        t = threading.Thread(target=worker, args=(q,))
-        t.start()
-        threads.append(t)
+    def close(self):
+        # Cancels the downloads in progress, keeping their partial files
+        self.broke.set()
+        for t in self.threads:
+            t.join()
+        self.pool.close()
+        for fn, done in self.done.items():
+            if not done.is_set():
+                self.failed[fn] = "cancelled"
+                done.set()
 
-    try:
-        for fn, url in missing.items():
-            q.put((fn, url))
-            if broke.is_set():
-                break
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
-        while not broke.is_set() and not q.empty():
-            time.sleep(0.2)
-    except Exception:
-        pass
 
-    if broke.is_set():
-        raise RuntimeError("Failed to download some files")
+def download_missing(missing: dict[str, str], sizes: dict[str, int] | None = None):
+    if not missing:
+        return
+
+    logger.info(f"Downloading {len(missing)} missing files...")
+    with (
+        span("download_missing", files=len(missing)),
+        DownloadQueue(missing, sizes, largest_first=True) as downloads,
+    ):
+        downloads.join()
+
 
-    q.join()
-    broke.set()
-    for t in threads:
-        t.join()
+def download_all(repos: list[Repository], cache: str):
+    # Every archive of the indexes, which share names across versions
+    missing = {}
+    sizes = {}
+    for repo in repos:
+        repo_missing, repo_sizes = get_missing(
+            repo, [(upd, None) for upd in repo.timeline], cache
+        )
+        for fn in repo_missing:
+            missing.setdefault(fn, repo_missing[fn])
+        sizes.update(repo_sizes)
+    total = sum(sizes.get(fn) or 0 for fn in missing)
+    logger.info(f"{len(missing)} archives ({total / 1024**3:.1f} GiB) to download")
+    download_missing(missing, sizes)
 
 
 def generate_upd_text(repo: Repository, upd: Update, added: list[str]) -> str:
@@ -406,6 +715,254 @@ def generate_upd_text(repo: Repository, upd: Update, added: list[str]) -> str:
     return "\n".join(lines)
 
 
+class StagedPackage(NamedTuple):
+    src: Sources
+    archive: str
+    pkgbuild: str
+    # Files of the package as (name, git mode, blob hash, contents)
+    # The contents are None if the blob hash is cached from a previous run
+    files: list[tuple[str, int, str, bytes | None]]
+
+
+def read_files(
+    pkg_fn: str, src: Sources, names: list[str], members: list[Member]
+) -> dict[str, tuple[int, bytes]]:
+    headers = {m.name: m for m in members}
+    regular = (tarfile.REGTYPE.decode(), tarfile.AREGTYPE.decode())
+    files = {}
+    wanted: list[tuple[str, int, Member]] = []
+    for fn in names:
+        member = headers.get(f"{src.pkg}/{fn}")
+        if member is None:
+            raise KeyError(f"filename '{src.pkg}/{fn}' not found in {pkg_fn}")
+
+        mode = MODE_EXEC if member.mode & 0o100 else MODE_FILE
+        if member.type == tarfile.DIRTYPE.decode():
+            continue
+        elif member.type == tarfile.SYMTYPE.decode():
+            files[fn] = (MODE_LINK, member.linkname.encode())
+        elif member.type in regular:
+            wanted.append((fn, mode, member))
+        elif (
+            member.type == tarfile.LNKTYPE.decode()
+            and headers.get(member.linkname, member).type in regular
+        ):
+            wanted.append((fn, mode, headers[member.linkname]))
+        else:
+            # Let tarfile handle anything else
+            return read_tar_files(pkg_fn, src, names)
+
+    if wanted:
+        data = read_members(pkg_fn, [member for _, _, member in wanted])
+        for (fn, mode, _), d in zip(wanted, data):
+            files[fn] = (mode, d)
+    return files
+
+
+def read_tar_files(
+    pkg_fn: str, src: Sources, names: list[str]
+) -> dict[str, tuple[int, bytes]]:
+    files = {}
+    with tarfile.open(pkg_fn, "r:gz") as tar:
+        for member in get_members(tar, src, names):
+            blob = read_member(tar, member)
+            if blob:
+                files[member.name] = blob
+    return files
+
+
+def stage_package(
+    pkg_name: str, cache: str, pull_remote: str | None = None
+) -> StagedPackage | None:
+    # Members hashed on a previous run are only read if they differ from the
+    # commit they are applied on
+    store = get_store(cache)
+    pkg_fn = os.path.join(cache, pkg_name)
+    src, members, read = load_sources(cache, pkg_name)
+    if not src:
+        logger.info(f"Failed to extract sources from {pkg_name}, skipping")
+        return None
+
+    pkgbuild = rewrite_pkgbuild(src.pkgbuild, pull_remote)
+    headers = {m.name: m for m in members}
+    files = []
+    unknown = []
+    for fn in get_member_names(src):
+        member = headers.get(f"{src.pkg}/{fn}")
+        if member is None:
+            raise KeyError(f"filename '{src.pkg}/{fn}' not found in {pkg_name}")
+        if member.type == tarfile.DIRTYPE.decode():
+            continue
+        if member.type == tarfile.SYMTYPE.decode():
+            link = member.linkname.encode()
+            files.append((fn, MODE_LINK, blob_hash(link), link))
+            continue
+
+        if fn in read:
+            mode, data = read[fn]
+            sha = blob_hash(data)
+            store.put_blob(pkg_fn, member, sha)
+            files.append((fn, mode, sha, data))
+            continue
+
+        # Hard links have the contents of another member
+        sha = None
+        if member.type != tarfile.LNKTYPE.decode():
+            sha = store.get_blob(pkg_fn, member)
+        if sha is None:
+            unknown.append(fn)
+        mode = MODE_EXEC if member.mode & 0o100 else MODE_FILE
+        files.append((fn, mode, sha, None))
+
+    if unknown:
+        # The archive is decompressed anyway, so the cached files are read too
+        logger.info(f"Extracting sources for {pkg_name}")
+        unread = [fn for fn, _, _, data in files if data is None]
+        blobs = read_files(pkg_fn, src, unread, members)
+        staged_files = []
+        for fn, mode, sha, data in files:
+            if data is None and fn in blobs:
+                mode, data = blobs[fn]
+                if sha is None:
+                    sha = blob_hash(data)
+                    store.put_blob(pkg_fn, headers[f"{src.pkg}/{fn}"], sha)
+            if sha is not None:
+                staged_files.append((fn, mode, sha, data))
+        files = staged_files
+
+    return StagedPackage(src, pkg_fn, pkgbuild, files)
+
+
+def get_package_files(pkg: StagedPackage) -> dict[str, tuple[int, str]]:
+    # The files of the package in the commit of its update, by mode and hash
+    files = {"PKGBUILD": (MODE_FILE, blob_hash(pkg.pkgbuild.encode()))}
+    for fn, mode, sha, _ in pkg.files:
+        files[fn] = (mode, sha)
+    return files
+
+
+def stage_update(
+    upd: Update,
+    cache: str,
+    pull_remote: str | None = None,
+    downloads: DownloadQueue | None = None,
+    parent_files: Callable[[], dict[str, dict[str, tuple[int, str]]]] | None = None,
+    cancel: threading.Event | None = None,
+) -> list[StagedPackage]:
+    # Decompress everything an update needs, so it can run ahead of git.
+    # `parent_files` returns the files of the packages in the commit the
+    # update is applied on, as far as they are known. The cached files of the
+    # other packages are all read
+    if downloads:
+        with span("wait for downloads", "download"):
+            downloads.wait(
+                [os.path.join(cache, pkg.name) for pkg in upd.packages], cancel
+            )
+    staged = []
+    for pkg in upd.packages:
+        with span(pkg.name, "package") as sp:
+            staged_pkg = stage_package(pkg.name, cache, pull_remote)
+            if staged_pkg:
+                sp.set(bytes=get_staged_size([staged_pkg]))
+                staged.append(staged_pkg)
+
+    parent = parent_files() if parent_files else {}
+    for i, pkg in enumerate(staged):
+        old = parent.get(pkg.src.pkg, {})
+        unread = [
+            fn
+            for fn, mode, sha, data in pkg.files
+            if data is None and old.get(fn) != (mode, sha)
+        ]
+        if not unread:
+            continue
+        name = os.path.basename(pkg.archive)
+        logger.info(f"Extracting sources for {name}")
+        _, members, _ = load_sources(cache, name)
+        with span(name, "package") as sp:
+            blobs = read_files(pkg.archive, pkg.src, unread, members)
+            sp.set(bytes=sum(len(data) for _, data in blobs.values()))
+        files = []
+        for fn, mode, sha, data in pkg.files:
+            if fn in blobs:
+                mode, data = blobs[fn]
+            files.append((fn, mode, sha, data))
+        staged[i] = pkg._replace(files=files)
+    return staged
+
+
+def get_staged_size(staged: list[StagedPackage]) -> int:
+    return sum(
+        len(p.pkgbuild) + sum(len(data) for *_, data in p.files if data) for p in staged
+    )
+
+
+def stage_ahead(
+    todo: list[tuple[Update, str | None]],
+    cache: str,
+    pull_remote: str | None,
+    lookahead: int,
+    lookahead_memory: int,
+    downloads: DownloadQueue | None = None,
+):
+    # Yields the updates of todo in order along with their staged packages.
+    # Up to `lookahead` updates are staged in worker threads (zlib releases
+    # the GIL) while the caller commits, as long as the staged data waiting
+    # to be committed stays below `lookahead_memory` bytes
+
+    # Each update applies on the one before it in todo, so the files of its
+    # parent are the ones of the packages staged so far. Only the first update
+    # applies on a commit whose files are not known
+    def stage(upd: Update, parent_files: Callable[[], dict] | None):
+        staged = stage_update(upd, cache, pull_remote, downloads, parent_files, stop)
+        files = dict(parent_files()) if parent_files else {}
+        for pkg in staged:
+            files[pkg.src.pkg] = get_package_files(pkg)
+        return staged, files
+
+    # Set when the caller stops early, so workers waiting for downloads exit
+    stop = threading.Event()
+    if lookahead <= 0:
+        files = None
+        for upd, begin_tag in todo:
+            staged, files = stage(upd, files.copy if files is not None else None)
+            yield upd, begin_tag, staged
+        return
+
+    from collections import deque
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+    ex = ThreadPoolExecutor(lookahead)
+    pending: deque[Future] = deque()
+    nxt = 0
+    last = None
+
+    def staged_size():
+        # Staged data of finished updates waiting to be committed
+        return sum(
+            get_staged_size(f.result()[0])
+            for f in pending
+            if f.done() and not f.exception()
+        )
+
+    try:
+        for upd, begin_tag in todo:
+            while nxt < len(todo) and (
+                not pending
+                or (len(pending) < lookahead and staged_size() < lookahead_memory)
+            ):
+                # Workers take the updates in order, so the one before is
+                # always running or done when an update waits for it
+                parent_files = (lambda prev=last: prev.result()[1]) if last else None
+                last = ex.submit(stage, todo[nxt][0], parent_files)
+                pending.append(last)
+                nxt += 1
+            yield upd, begin_tag, pending.popleft().result()[0]
+    finally:
+        stop.set()
+        ex.shutdown(wait=True, cancel_futures=True)
+
+
 def process_update(
     repo: Repository,
     upd: Update,
@@ -418,100 +975,216 @@ def process_update(
     should_resume: bool = False,
     pull_remote: str | None = None,
     readme: str | None = None,
-    update_interval: int = 1,
-):
+    fast_import: FastImport | None = None,
+    staged: list[StagedPackage] | None = None,
+    trees: TreeCache | None = None,
+) -> str:
     tag_name = get_name_from_update(repo, upd)
+    readme_text = None
     if begin_tag is None:
         assert (
             not should_resume
         ), "Cannot start from the beginning. Did the repo change?"
-        srun(["git", "-C", repo_path, "checkout", "--orphan", repo.version])
         if readme:
             with open(readme, "r") as f:
                 readme_text = f.read()
                 readme_text = readme_text.replace(
                     "<replace-repo>", repo.branch
                 ).replace("<replace-repo-cap>", repo.branch.capitalize())
+
+    if staged is None:
+        staged = stage_update(upd, cache, pull_remote)
+
+    # With fast-import, the changes are streamed instead of written to a worktree
+    changes: list[tuple[str, int, bytes] | str] = []
+    parent = tags[begin_tag] if begin_tag is not None else None
+    if fast_import:
+        tree = fast_import.get_tree(parent) if parent else {}
+    else:
+        if trees is None:
+            trees = TreeCache(repo_path)
+        if parent:
+            srun(["git", "-C", repo_path, "checkout", parent])
+        else:
+            # Updates without a parent start from an empty tree, like with
+            # fast-import, instead of the files of the current checkout
+            srun(["git", "-C", repo_path, "checkout", "--orphan", repo.version])
+            srun(["git", "-C", repo_path, "read-tree", "--empty"])
+            srun(["git", "-C", repo_path, "clean", "-q", "-ffdx"])
+        tree = trees.get(parent) if parent else {}
+
+    new_tree = dict(tree)
+    if readme_text is not None:
+        readme_data = readme_text.encode()
+        new_tree["readme.md"] = {"": (MODE_FILE, blob_hash(readme_data))}
+        if fast_import:
+            changes.append(("readme.md", MODE_FILE, readme_data))
+        else:
             with open(os.path.join(repo_path, "readme.md"), "w") as f:
                 f.write(readme_text)
             srun(["git", "-C", repo_path, "add", "readme.md"])
-    else:
-        begin_hash = tags[begin_tag]
-        srun(["git", "-C", repo_path, "checkout", begin_hash])
     added = []
 
-    for pkg in upd.packages:
-        pkg_fn = os.path.join(cache, pkg.name)
-
-        with tarfile.open(pkg_fn, "r:gz") as tar:
-            src = extract_sources(pkg.name, tar)
-            if not src:
-                logger.info(f"Failed to extract sources from {pkg.name}, skipping")
-                continue
-
-            # Remove existing folder
-            pkg_path = os.path.join(repo_path, src.pkg)
-            if os.path.exists(pkg_path):
-                shutil.rmtree(pkg_path)
+    for pkg in staged:
+        src = pkg.src
+        old = new_tree.get(src.pkg)
+        if old is None:
+            added.append(src.pkg)
+            old = {}
+
+        pkgbuild = pkg.pkgbuild.encode()
+        want = {"PKGBUILD": (MODE_FILE, blob_hash(pkgbuild), pkgbuild)}
+        for fn, mode, sha, data in pkg.files:
+            want[fn] = (mode, sha, data)
+
+        # Only touch the files that differ from the parent commit
+        removed = [fn for fn in old if fn not in want]
+        changed = [
+            fn for fn, (mode, sha, _) in want.items() if old.get(fn) != (mode, sha)
+        ]
+
+        for fn in removed:
+            if fast_import:
+                changes.append(join_path(src.pkg, fn))
             else:
-                added.append(src.pkg)
-            os.makedirs(pkg_path, exist_ok=True)
-
-            # Write PKGBUILD
-            with open(os.path.join(pkg_path, "PKGBUILD"), "w") as f:
-                pkgbuild = src.pkgbuild
-                if pull_remote:
-                    for pattern in INTERNAL_REPLACE:
-                        pkgbuild = re.sub(pattern, pull_remote, pkgbuild)
-                f.write(pkgbuild)
-
-            # Write other files if necessary
-            if not src.files and not src.repos:
-                continue
-
-            logger.info(f"Extracting sources for {pkg.name}")
-            for fn in src.files:
-                # cleanup fn
-                if "libssh2" in src.pkg:
-                    # _name=${pkgname#lib32-}
-                    # $_name-1.11.1-CVE-2026-55200.patch
-                    fn = fn.replace("$_name", "libssh2")
+                os.remove(os.path.join(repo_path, join_path(src.pkg, fn)))
+        for fn in changed:
+            mode, _, data = want[fn]
+            assert data is not None, f"Could not read {fn} from {pkg.archive}"
+            if fast_import:
+                changes.append((f"{src.pkg}/{fn}", mode, data))
+            else:
+                write_file(os.path.join(repo_path, src.pkg, fn), mode, data)
 
-                member = tar.getmember(f"{src.pkg}/{fn}")
-                member.name = fn  # Prevent path traversal
-                tar.extract(member, pkg_path)
+        new_tree[src.pkg] = {fn: (mode, sha) for fn, (mode, sha, _) in want.items()}
 
     upd_text = generate_upd_text(repo, upd, added)
     logger.info(f"Update ({i:04d}/{total}): {upd_text}\n")
-    srun(["git", "-C", repo_path, "add", "."])
-    srun(
-        [
-            "git",
-            "-C",
-            repo_path,
-            "commit",
-            "-m",
+    if fast_import:
+        ghash = fast_import.commit(
+            repo.version,
+            tags[begin_tag] if begin_tag is not None else None,
+            upd.date,
             upd_text,
-            "--date",
-            upd.date.isoformat(),
-        ],
-        env={"GIT_COMMITTER_DATE": upd.date.isoformat()},
-    )
-    ghash = srun(["git", "-C", repo_path, "rev-parse", "HEAD"])
-    tags[tag_name] = ghash
-
-    if (i + 1) % update_interval == 0 or i + 1 == total:
+            changes,
+            new_tree,
+        )
+    else:
+        srun(["git", "-C", repo_path, "add", "."])
         srun(
             [
                 "git",
                 "-C",
                 repo_path,
-                "push",
-                "origin",
-                f"{ghash}:refs/heads/{repo.version}",
-                *(["--force"] if not should_resume else []),
-            ]
+                "commit",
+                "-m",
+                upd_text,
+                "--date",
+                upd.date.isoformat(),
+            ],
+            env={"GIT_COMMITTER_DATE": upd.date.isoformat()},
+        )
+        ghash = srun(["git", "-C", repo_path, "rev-parse", "HEAD"])
+        # The next update starts from this commit, without listing its tree
+        trees.put(ghash, new_tree)
+    tags[tag_name] = ghash
+    return ghash
+
+
+class PushScheduler:
+    """Collects the branch updates of all versions of a repository and pushes
+    them together with a single `git push`, once enough commits, bytes or
+    time have accumulated."""
+
+    def __init__(
+        self,
+        repo_path: str,
+        interval: int = 1,
+        max_bytes: int = PUSH_BYTES,
+        max_seconds: float = PUSH_SECONDS,
+    ):
+        self.repo_path = repo_path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.atomic = True
+
+        self.refs: dict[str, tuple[str, bool]] = {}
+        self.commits = 0
+        self.size = 0
+        self.start = None
+
+    def add(self, branch: str, ghash: str, force: bool = False, size: int = 0):
+        import time
+
+        if self.start is None:
+            self.start = time.monotonic()
+        _, forced = self.refs.get(branch, (None, False))
+        self.refs[branch] = (ghash, force or forced)
+        self.commits += 1
+        self.size += size
+
+    def due(self) -> bool:
+        import time
+
+        if not self.refs:
+            return False
+        return (
+            self.commits >= self.interval
+            or (self.max_bytes and self.size >= self.max_bytes)
+            or (self.max_seconds and time.monotonic() - self.start >= self.max_seconds)
+        )
+
+    def push(self):
+        if not self.refs:
+            return
+        with span("push", refs=list(self.refs), commits=self.commits):
+            self._push()
+
+    def _push(self):
+        refspecs = [
+            f"{'+' if force else ''}{ghash}:refs/heads/{branch}"
+            for branch, (ghash, force) in self.refs.items()
+        ]
+        logger.info(
+            f"Pushing {self.commits} commits to {', '.join(self.refs)} "
+            f"({self.size / 1024**2:.1f} MiB of archives)"
         )
+        cmd = ["git", "-C", self.repo_path, "push", "origin"]
+        if self.atomic:
+            result = run_cmd(
+                cmd + ["--atomic", *refspecs], capture_output=True, text=True
+            )
+            if result.returncode != 0 and "does not support --atomic" in result.stderr:
+                # The remote does not support atomic pushes
+                self.atomic = False
+            elif result.returncode != 0:
+                logger.info(f"Command failed with code {result.returncode}")
+                logger.info(f"stdout: {result.stdout}")
+                logger.info(f"stderr: {result.stderr}")
+                raise RuntimeError(f"Command {' '.join(cmd)} --atomic failed")
+        if not self.atomic:
+            srun(cmd + refspecs)
+
+        self.refs.clear()
+        self.commits = 0
+        self.size = 0
+        self.start = None
+
+
+def get_missing(
+    repo: Repository, todo: list[tuple[Update, str | None]], cache: str
+) -> tuple[dict[str, str], dict[str, int]]:
+    # Urls and sizes of the archives of the updates that are not cached
+    missing = {}
+    sizes = {}
+    for upd, _ in todo:
+        for pkg in upd.packages:
+            fn = os.path.join(cache, pkg.name)
+            if not os.path.exists(fn) and fn not in missing:
+                missing[fn] = repo.url + "/" + pkg.link
+                sizes[fn] = pkg.size
+    return missing, sizes
 
 
 def process_repo(
@@ -527,38 +1200,191 @@ def process_repo(
     readme: str | None = None,
     update_interval: int = 1,
     force_push: list[str] | None = None,
+    fast_import: bool = False,
+    todo: list[tuple[Update, str | None]] | None = None,
+    lookahead: int = LOOKAHEAD,
+    lookahead_memory: int = LOOKAHEAD_MEMORY,
+    pusher: PushScheduler | None = None,
+    downloads: DownloadQueue | None = None,
 ):
-    todo = get_upd_todo(tags, repo.latest, repo, trunk)
+    # Without a shared scheduler, all updates are pushed before returning
+    own_pusher = pusher is None
+    if pusher is None:
+        pusher = PushScheduler(repo_path, update_interval)
+
+    if todo is None:
+        todo = get_upd_todo(tags, repo.latest, repo, trunk)
 
     logger.info(f"Processing {repo.name} ({len(todo)} updates to apply)")
+    if not todo:
+        return
 
-    missing = {}
-    for upd, _ in todo:
-        for pkg in upd.packages:
-            fn = os.path.join(cache, pkg.name)
-            if not os.path.exists(fn) and fn not in missing:
-                missing[fn] = repo.url + "/" + pkg.link
+    # Archives are downloaded in the order of the updates, which are
+    # committed as soon as their own archives are there
+    own_downloads = downloads is None
+    if downloads is None:
+        missing, sizes = get_missing(repo, todo, cache)
+        if missing:
+            logger.info(f"Downloading {len(missing)} missing files in the background")
+        downloads = DownloadQueue(missing, sizes)
+
+    staged_todo = stage_ahead(
+        todo, cache, pull_remote, lookahead, lookahead_memory, downloads
+    )
+    with (
+        closing(downloads) if own_downloads else nullcontext(),
+        span(f"commit {repo.name}", updates=len(todo)),
+        closing(staged_todo),
+        FastImport(repo_path) if fast_import else nullcontext() as fi,
+    ):
+        trees = None if fi else TreeCache(repo_path)
+        for i, (upd, begin_tag, staged) in enumerate(staged_todo):
+            should_resume_branch = should_resume and (
+                not force_push or repo.version not in force_push
+            )
+
+            size = sum(pkg.size or 0 for pkg in upd.packages)
+            with span(get_name_from_update(repo, upd), "update", bytes=size):
+                ghash = process_update(
+                    repo,
+                    upd,
+                    begin_tag,
+                    cache,
+                    repo_path,
+                    i,
+                    len(todo),
+                    tags,
+                    should_resume_branch,
+                    pull_remote,
+                    readme,
+                    fi,
+                    staged,
+                    trees,
+                )
+
+            pusher.add(repo.version, ghash, force=not should_resume_branch, size=size)
+            if pusher.due():
+                if fi:
+                    fi.checkpoint()
+                pusher.push()
+
+    if own_pusher:
+        pusher.push()
+
+
+def add_worktree(
+    repo_path: str, path: str, commit: str, lock: AbstractContextManager
+) -> str:
+    # Detached worktree at commit, sharing the objects of repo_path. Git
+    # does not lock the worktree metadata, so changes to it are serialized
+    with lock:
+        if os.path.exists(path):
+            # Left by a run that was killed, its registration has to go too
+            shutil.rmtree(path)
+            srun(["git", "-C", repo_path, "worktree", "prune"])
+        srun(["git", "-C", repo_path, "worktree", "add", "--detach", path, commit])
+    return path
+
+
+def process_branches(
+    repos: list[Repository],
+    trunk: Repository,
+    cache: str,
+    tags: dict[str, str],
+    repo_path: str,
+    work_dir: str,
+    todos: dict[str, list[tuple[Update, str | None]]],
+    parallel_versions: int = PARALLEL_VERSIONS,
+    update_interval: int = 1,
+    push_bytes: int = PUSH_BYTES,
+    push_seconds: float = PUSH_SECONDS,
+    lookahead_memory: int = LOOKAHEAD_MEMORY,
+    **kwargs,
+):
+    """Processes the maintenance branches of a trunk that was already
+    processed. They only share trunk commits, so each runs in its own
+    worktree with its own copy of the tags, which are merged back after."""
+    from concurrent.futures import ThreadPoolExecutor
 
-    download_missing(missing)
+    repos = [repo for repo in repos if todos[repo.name]]
+    if not repos:
+        return
 
-    for i, (upd, begin_tag) in enumerate(todo):
-        should_resume_branch = should_resume and (
-            not force_push or repo.version not in force_push
+    # A single queue for all branches, so they never fetch the same archive.
+    # The updates of the branches are interleaved, so each can start early
+    missing = {}
+    sizes = {}
+    for i in range(max(len(todos[repo.name]) for repo in repos)):
+        for repo in repos:
+            todo = todos[repo.name]
+            repo_missing, repo_sizes = get_missing(repo, todo[i : i + 1], cache)
+            for fn in repo_missing:
+                missing.setdefault(fn, repo_missing[fn])
+            sizes.update(repo_sizes)
+    if missing:
+        logger.info(f"Downloading {len(missing)} missing files in the background")
+    downloads = DownloadQueue(missing, sizes)
+
+    trunk_tag = get_name_from_update(trunk, trunk.latest)
+    # Worktrees left by an interrupted run
+    srun(["git", "-C", repo_path, "worktree", "prune"])
+    worktree_lock = threading.Lock()
+
+    def process_branch(repo: Repository) -> dict[str, str]:
+        path = os.path.abspath(
+            os.path.join(work_dir, "worktrees", f"{repo.branch}-{repo.version}")
         )
+        # Start from the fork point. Branches without one start from an
+        # empty tree, the trunk is only checked out to create the worktree
+        todo = todos[repo.name]
+        begin_tag = todo[0][1] if todo else None
+        start = tags[begin_tag] if begin_tag else tags.get(trunk_tag, "HEAD")
+        add_worktree(repo_path, path, start, worktree_lock)
+        branch_tags = dict(tags)
+        # Pushes are coalesced per branch, as the commits of other branches
+        # may still be in their fast-import stream
+        pusher = PushScheduler(path, update_interval, push_bytes, push_seconds)
+        try:
+            process_repo(
+                repo,
+                trunk=trunk,
+                cache=cache,
+                tags=branch_tags,
+                repo_path=path,
+                work_dir=work_dir,
+                update_interval=update_interval,
+                todo=todos[repo.name],
+                lookahead_memory=lookahead_memory // parallel_versions,
+                pusher=pusher,
+                downloads=downloads,
+                **kwargs,
+            )
+            pusher.push()
+        finally:
+            with worktree_lock:
+                srun(
+                    ["git", "-C", repo_path, "worktree", "remove", "--force", path],
+                    error=False,
+                )
+        return branch_tags
 
-        process_update(
-            repo,
-            upd,
-            begin_tag,
-            cache,
-            repo_path,
-            i,
-            len(todo),
-            tags,
-            should_resume_branch,
-            pull_remote,
-            readme,
-            update_interval,
+    logger.info(
+        f"Processing {len(repos)} branches of {trunk.branch} "
+        f"({parallel_versions} at a time)"
+    )
+    failed = []
+    with downloads, ThreadPoolExecutor(max(parallel_versions, 1)) as ex:
+        futures = {repo.name: ex.submit(process_branch, repo) for repo in repos}
+        for name, fut in futures.items():
+            try:
+                tags.update(fut.result())
+            except Exception as e:
+                logger.info(f"Failed to process {name}: {e}")
+                failed.append(name)
+
+    if failed:
+        raise RuntimeError(
+            f"Failed to process {len(failed)} branches: {', '.join(failed)}"
         )
 
 
@@ -568,10 +1394,9 @@ def check_repos(cache: str):
     fns = os.listdir(cache)
     for i, fn in enumerate(fns):
         if fn.endswith(".src.tar.gz") and infer_name(fn) not in seen:
-            with tarfile.open(os.path.join(cache, fn), "r:gz") as tar:
-                src = extract_sources(fn, tar)
-                if not src:
-                    continue
+            src, *_ = load_sources(cache, fn)
+            if not src:
+                continue
             logger.info(f"Package ({i:04d}/{len(fns)}): {fn}")
 
             for name, unpack, url in src.repos:
@@ -583,6 +1408,140 @@ def check_repos(cache: str):
         logger.info(f"{name:40s} -> {unpack}:: {url}")
 
 
+def get_remote_refs(url: str) -> dict[str, str] | None:
+    try:
+        out = srun(["git", "ls-remote", url], silent=True)
+    except RuntimeError:
+        return None
+    refs = {}
+    for line in out.splitlines():
+        sha, _, ref = line.partition("\t")
+        # Peeled tags and HEAD are not refs of their own
+        if ref.startswith("refs/") and not ref.endswith("^{}"):
+            refs[ref] = sha
+    return refs
+
+
+def get_pushed_refs(repo_name: str, refs: dict[str, str]) -> dict[str, str]:
+    # The refs a push of the mirror leaves on the remote
+    if "mesa" in repo_name:
+        return {
+            ref: sha
+            for ref, sha in refs.items()
+            if ref.startswith("refs/heads/")
+            or (ref.startswith("refs/tags/") and "steamos" in ref)
+        }
+    return refs
+
+
+def push_internal_repo(
+    cache: str,
+    work_dir: str,
+    remote: str,
+    pkg_name: str,
+    src_pkg: str,
+    repo_name: str,
+    unpack_name: str,
+    members: list[Member] | None = None,
+):
+    # The repo is imported into a persistent mirror, so only new objects are
+    # written and the push only has to send what changed
+    mirror_dir = get_mirror_path(cache, repo_name)
+    archive = os.path.join(cache, pkg_name)
+    prefix = f"{src_pkg}/{unpack_name}/"
+    url = remote + "/" + repo_name
+
+    # Skip repos whose refs match the ones of the last successful push, as
+    # long as the remote still has them
+    store = get_store(cache)
+    refs = None
+    if members:
+        try:
+            refs = read_archive_refs(archive, prefix, members)
+        except (OSError, EOFError, UnicodeDecodeError) as e:
+            logger.info(f"Could not read the refs of {repo_name}: {e}")
+    if refs and store.get_pushed(url) == refs:
+        if get_remote_refs(url) == get_pushed_refs(repo_name, refs):
+            logger.info(f"Repo {repo_name} from package {pkg_name} is up to date")
+            return False
+        logger.info(f"Remote of {repo_name} changed since the last push")
+
+    logger.info(f"Pushing repo {repo_name} from package {pkg_name}")
+    try:
+        refs = import_repo(archive, prefix, mirror_dir)
+    except (RuntimeError, tarfile.TarError, OSError) as e:
+        logger.info(f"Could not import {repo_name} ({e}), extracting it instead")
+        fetch_extracted_repo(
+            cache, work_dir, pkg_name, src_pkg, repo_name, unpack_name, mirror_dir
+        )
+        refs = get_refs(mirror_dir)
+    if not refs:
+        # A mirror push would delete every ref of the remote
+        raise RuntimeError(f"Repo {repo_name} from package {pkg_name} has no refs")
+
+    if "mesa" in repo_name:
+        # Only push steamos tags, unfortunately certain mesa tags are corrupted
+        steamos_tags = [
+            t
+            for t in srun(["git", "--git-dir", mirror_dir, "tag"]).split("\n")
+            if "steamos" in t
+        ]
+        srun(
+            ["git", "--git-dir", mirror_dir, "push", url] + steamos_tags,
+        )
+        srun(
+            [
+                "git",
+                "--git-dir",
+                mirror_dir,
+                "push",
+                "--all",
+                url,
+                "--force",
+                "--prune",
+            ],
+        )
+    else:
+        srun(
+            ["git", "--git-dir", mirror_dir, "push", "--mirror", url],
+        )
+
+    store.put_pushed(url, refs)
+    logger.info(f"Pushed repo {repo_name} from package {pkg_name}")
+    return True
+
+
+def fetch_extracted_repo(
+    cache: str,
+    work_dir: str,
+    pkg_name: str,
+    src_pkg: str,
+    repo_name: str,
+    unpack_name: str,
+    mirror_dir: str,
+):
+    # Extract under a directory per repo, so pushes can run in parallel
+    extract_dir = os.path.join(work_dir, "mirrors", repo_name)
+    repo_dir = os.path.join(extract_dir, unpack_name)
+    if os.path.exists(extract_dir):
+        shutil.rmtree(extract_dir)
+
+    # Extract repo from tar
+    def filter_repo(tarinfo, root):
+        if tarinfo.name.startswith(f"{src_pkg}/{unpack_name}/"):
+            tarinfo.name = tarinfo.name.split("/", 1)[1]
+            return tarinfo
+        return None
+
+    try:
+        with tarfile.open(os.path.join(cache, pkg_name), "r:gz") as tar:
+            tar.extractall(path=extract_dir, filter=filter_repo)
+        fetch_repo(os.path.abspath(repo_dir), mirror_dir)
+    finally:
+        # Save memory
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+
 def find_and_push_latest(
     cache: str,
     work_dir: str,
@@ -590,6 +1549,8 @@ def find_and_push_latest(
     pairs: list[tuple[Repository, Repository | None, dict[str, str]]],
     push_all: bool = True,
     should_resume: bool = False,
+    plans: dict[str, list[tuple[Update, str | None]]] | None = None,
+    parallel_pushes: int = PARALLEL_PUSHES,
 ):
     all_upds: list[tuple[Repository, Update]] = []
     upds: list[tuple[Repository, Update]] = []
@@ -606,8 +1567,10 @@ def find_and_push_latest(
     if push_all:
         upds = all_upds
     else:
+        if plans is None:
+            plans = get_plans(pairs)
         for repo, trunk, tags in pairs:
-            for upd, tag in get_upd_todo(tags, repo.latest, repo, trunk):
+            for upd, tag in plans[repo.name]:
                 if should_resume:
                     assert (
                         tag
@@ -660,81 +1623,67 @@ def find_and_push_latest(
     logger.info(f"Found {len(packages)} packages to push")
 
     missing = {}
+    sizes = {}
     for name, (pkg, repo, _) in packages.items():
         fn = os.path.join(cache, pkg.name)
         if not os.path.exists(fn) and fn not in missing:
             missing[fn] = repo.url + "/" + pkg.link
+            sizes[fn] = pkg.size
 
-    download_missing(missing)
+    download_missing(missing, sizes)
 
+    # Group the repos by name, pushes to the same repo run one at a time
+    jobs: dict[str, list[tuple[str, str, str, list[Member]]]] = {}
     for name, (pkg, repo, _) in packages.items():
-        pkg_fn = os.path.join(cache, pkg.name)
+        src, members, _ = load_sources(cache, pkg.name)
+        if not src:
+            logger.info(f"Failed to extract sources from {pkg.name}, skipping")
+            continue
+
+        for repo_name, unpack_name, _ in src.repos:
+            jobs.setdefault(repo_name, []).append(
+                (pkg.name, src.pkg, unpack_name, members)
+            )
 
-        with tarfile.open(pkg_fn, "r:gz") as tar:
-            src = extract_sources(pkg.name, tar)
-            if not src:
-                logger.info(f"Failed to extract sources from {pkg.name}, skipping")
-                continue
+    if not jobs:
+        return
 
-            for repo_name, unpack_name, _ in src.repos:
-                repo_dir = os.path.join(work_dir, unpack_name)
-                if os.path.exists(repo_dir):
-                    srun(["rm", "-rf", repo_dir])
-
-                logger.info(f"Pushing repo {repo_name} from package {pkg.name}")
-
-                # Extract repo from tar
-                pkg_name = src.pkg
-
-                def filter_repo(tarinfo, root):
-                    if tarinfo.name.startswith(f"{pkg_name}/{unpack_name}/"):
-                        tarinfo.name = tarinfo.name.split("/", 1)[1]
-                        return tarinfo
-                    return None
-
-                tar.extractall(path=work_dir, filter=filter_repo)
-
-                # Add remote and push everything
-                run(
-                    [
-                        "git",
-                        "-C",
-                        repo_dir,
-                        "remote",
-                        "add",
-                        "mirror",
-                        remote + "/" + repo_name,
-                    ]
+    from concurrent.futures import ThreadPoolExecutor
+
+    skipped = []
+
+    def push_all_of(repo_name: str):
+        for pkg_name, src_pkg, unpack_name, members in jobs[repo_name]:
+            with span(repo_name, "internal repo", package=pkg_name) as sp:
+                pushed = push_internal_repo(
+                    cache,
+                    work_dir,
+                    remote,
+                    pkg_name,
+                    src_pkg,
+                    repo_name,
+                    unpack_name,
+                    members,
                 )
-                if "mesa" in repo_name:
-                    # Only push steamos tags, unfortunately certain mesa tags are corrupted
-                    steamos_tags = [
-                        t
-                        for t in srun(["git", "-C", repo_dir, "tag"]).split("\n")
-                        if "steamos" in t
-                    ]
-                    run(
-                        ["git", "-C", repo_dir, "push", "mirror"] + steamos_tags,
-                    )
-                    run(
-                        [
-                            "git",
-                            "-C",
-                            repo_dir,
-                            "push",
-                            "--all",
-                            "mirror",
-                            "--force",
-                            "--prune",
-                        ],
-                    )
-                else:
-                    run(
-                        ["git", "-C", repo_dir, "push", "--mirror", "mirror"],
-                    )
-
-                # Save memory
-                shutil.rmtree(repo_dir)
+                sp.set(pushed=pushed)
+                if not pushed:
+                    skipped.append(repo_name)
+
+    logger.info(f"Pushing {len(jobs)} repos ({parallel_pushes} at a time)")
+    failed = []
+    with ThreadPoolExecutor(max(parallel_pushes, 1)) as ex:
+        futures = {name: ex.submit(push_all_of, name) for name in jobs}
+        for name, fut in futures.items():
+            try:
+                fut.result()
+            except Exception as e:
+                logger.info(f"Failed to push repo {name}: {e}")
+                failed.append(name)
+
+    if skipped:
+        logger.info(f"Skipped {len(skipped)} repos with unchanged refs")
+    if failed:
+        raise RuntimeError(f"Failed to push {len(failed)} repos: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,149 @@
+"""Records spans of a run in the Chrome trace event format, which can be opened
+with chrome://tracing or https://ui.perfetto.dev. Tracing is off unless
+`start_trace` is called, and `span` is then nearly free."""
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, cat: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = 0
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.add(self, time.perf_counter_ns())
+
+
+class NullSpan:
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+_NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    def __init__(self, fn: str):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter_ns()
+        self.pid = os.getpid()
+        self.events: list[dict] = []
+        self.threads: set[int] = set()
+
+    def _ts(self, ns: int) -> float:
+        # Microseconds since the start of the trace
+        return (ns - self.origin) / 1000
+
+    def add(self, span: Span, end: int):
+        tid = threading.get_ident()
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self.pid,
+                        "tid": tid,
+                        "args": {"name": threading.current_thread().name},
+                    }
+                )
+            self.events.append(
+                {
+                    "name": span.name,
+                    "cat": span.cat,
+                    "ph": "X",
+                    "ts": self._ts(span.start),
+                    "dur": (end - span.start) / 1000,
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": span.args,
+                }
+            )
+            # ru_maxrss is in KiB on Linux
+            self.events.append(
+                {
+                    "name": "peak rss (MiB)",
+                    "ph": "C",
+                    "ts": self._ts(end),
+                    "pid": self.pid,
+                    "args": {"evlav": own / 1024, "subprocesses": children / 1024},
+                }
+            )
+
+    def write(self):
+        with self.lock:
+            events = list(self.events)
+        with open(self.fn, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logger.info(f"Wrote {len(events)} trace events to '{self.fn}'")
+
+
+_tracer: Tracer | None = None
+
+
+def span(name: str, cat: str = "stage", **args) -> Span | NullSpan:
+    """Times the enclosed block. Further arguments, such as the bytes
+    processed, can be added with `.set()` on the returned span."""
+    if _tracer is None:
+        return _NULL_SPAN
+    return Span(_tracer, name, cat, args)
+
+
+def _cmd_name(cmd: list[str]) -> str:
+    # E.g., 'git push' for ['git', '-C', path, 'push', ...]
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg in ("-C", "-c", "--git-dir", "--work-tree"):
+            next(args, None)
+        elif not arg.startswith("-"):
+            return f"{cmd[0]} {arg}"
+    return cmd[0]
+
+
+def run_cmd(cmd: list[str], **kwargs):
+    """`subprocess.run` in a span named after the command."""
+    import subprocess
+
+    with span(_cmd_name(cmd), "subprocess", cmd=cmd):
+        return subprocess.run(cmd, **kwargs)
+
+
+def start_trace(fn: str):
+    global _tracer
+    _tracer = Tracer(fn)
+
+
+def stop_trace():
+    global _tracer
+    if _tracer is not None:
+        _tracer.write()
+        _tracer = None
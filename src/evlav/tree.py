@@ -0,0 +1,62 @@
+import hashlib
+from collections import OrderedDict
+
+from .trace import run_cmd
+
+# Files of a commit as {top level entry: {rest of path: (mode, blob hash)}}
+# Top level files have an empty rest of path
+Tree = dict[str, dict[str, tuple[int, str]]]
+
+TREE_CACHE_SIZE = 16
+
+
+def blob_hash(data: bytes) -> str:
+    # Same as `git hash-object`
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def join_path(top: str, rest: str) -> str:
+    return f"{top}/{rest}" if rest else top
+
+
+class TreeCache:
+    """Keeps the files of the last few commits, loading others with
+    `git ls-tree`."""
+
+    def __init__(self, repo_path: str, size: int = TREE_CACHE_SIZE):
+        self.repo_path = repo_path
+        self.size = size
+        self.trees: OrderedDict[str, Tree] = OrderedDict()
+
+    def load(self, ghash: str) -> Tree:
+        out = run_cmd(
+            ["git", "-C", self.repo_path, "ls-tree", "-r", "-z", ghash],
+            capture_output=True,
+        )
+        if out.returncode != 0:
+            raise RuntimeError(f"Could not list tree of {ghash}")
+
+        tree: Tree = {}
+        for line in out.stdout.split(b"\0"):
+            if not line:
+                continue
+            info, path = line.split(b"\t", 1)
+            mode, _, sha = info.decode().split(" ")
+            top, _, rest = path.decode().partition("/")
+            tree.setdefault(top, {})[rest] = (int(mode, 8), sha)
+        return tree
+
+    def get(self, ghash: str) -> Tree:
+        # The returned tree is shared and should not be modified
+        if ghash in self.trees:
+            self.trees.move_to_end(ghash)
+            return self.trees[ghash]
+        tree = self.load(ghash)
+        self.put(ghash, tree)
+        return tree
+
+    def put(self, ghash: str, tree: Tree):
+        self.trees[ghash] = tree
+        self.trees.move_to_end(ghash)
+        while len(self.trees) > self.size:
+            self.trees.popitem(last=False)
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import os
+import zlib
+
+from .download import DownloadError, check_size
+from .index import parse_index
+from .metadata import get_store
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_DIR = "quarantine"
+CHUNK_SIZE = 1024**2
+
+
+def verify_archive(fn: str) -> tuple[str, str | None]:
+    # Decompresses the whole archive, which checks the CRC and size of every
+    # gzip member. Returns the digest of the file and an error, if any
+    digest = hashlib.sha256()
+    d = zlib.decompressobj(wbits=31)
+    empty = True
+    try:
+        with open(fn, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+                empty = False
+                while chunk:
+                    if d.eof:
+                        if not chunk.strip(b"\0"):
+                            # Zero padding after the last member
+                            break
+                        # Concatenated gzip member
+                        d = zlib.decompressobj(wbits=31)
+                    d.decompress(chunk, CHUNK_SIZE)
+                    chunk = d.unused_data if d.eof else d.unconsumed_tail
+    except (OSError, zlib.error) as e:
+        return digest.hexdigest(), str(e)
+    if empty:
+        return digest.hexdigest(), "empty file"
+    if not d.eof:
+        return digest.hexdigest(), "truncated archive"
+    return digest.hexdigest(), None
+
+
+def get_index_sizes(cache: str) -> dict[str, set[int]]:
+    # Sizes of all packages in the cached indexes. An archive listed in
+    # several indexes may have a different size in each
+    store = get_store(cache)
+    sizes: dict[str, set[int]] = {}
+    for fn in sorted(os.listdir(cache)):
+        if not fn.endswith(".html"):
+            continue
+        with open(os.path.join(cache, fn), "rb") as f:
+            packages = parse_index(fn.removesuffix(".html"), f.read(), store)
+        for pkg in packages:
+            if pkg.size:
+                sizes.setdefault(pkg.name, set()).add(pkg.size)
+    return sizes
+
+
+def check_index_size(name: str, actual: int, expected: set[int]):
+    # Valid if it matches any of the indexes
+    error = None
+    for size in sorted(expected):
+        try:
+            check_size(name, actual, size)
+            return
+        except DownloadError as e:
+            error = error or e
+    if error:
+        raise error
+
+
+def quarantine(cache: str, name: str, reason: str):
+    qdir = os.path.join(cache, QUARANTINE_DIR)
+    os.makedirs(qdir, exist_ok=True)
+    os.rename(os.path.join(cache, name), os.path.join(qdir, name))
+    logger.info(f"Quarantined '{name}': {reason}")
+
+
+def verify_cache(cache: str, workers: int | None = None, recheck: bool = False):
+    """Verifies the archives in the cache with a process pool. Archives that
+    were verified before and have not changed are skipped. Invalid archives
+    are moved to the quarantine directory of the cache."""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    store = get_store(cache)
+    sizes = get_index_sizes(cache)
+
+    todo = []
+    bad = 0
+    skipped = 0
+    for name in sorted(os.listdir(cache)):
+        fn = os.path.join(cache, name)
+        if not name.endswith(".tar.gz") or not os.path.isfile(fn):
+            continue
+
+        st = os.stat(fn)
+        try:
+            check_index_size(name, st.st_size, sizes.get(name, set()))
+        except DownloadError as e:
+            quarantine(cache, name, str(e))
+            store.remove_verified(name)
+            bad += 1
+            continue
+
+        if not recheck and store.is_verified(name, st.st_size, st.st_mtime_ns):
+            skipped += 1
+            continue
+        todo.append((name, st.st_size, st.st_mtime_ns))
+
+    logger.info(
+        f"Verifying {len(todo)} archives ({skipped} unchanged since last verified)"
+    )
+    with ProcessPoolExecutor(workers or os.cpu_count()) as ex:
+        futures = {
+            ex.submit(verify_archive, os.path.join(cache, name)): (name, size, mtime)
+            for name, size, mtime in todo
+        }
+        for i, fut in enumerate(as_completed(futures)):
+            name, size, mtime = futures[fut]
+            digest, error = fut.result()
+            if error:
+                quarantine(cache, name, error)
+                store.remove_verified(name)
+                bad += 1
+            else:
+                store.put_verified(name, size, mtime, digest)
+            if (i + 1) % 100 == 0:
+                logger.info(f"Verified {i + 1}/{len(todo)} archives")
+
+    logger.info(f"Verification done, {bad} invalid archives quarantined")
+    return bad
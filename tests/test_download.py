@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+
+import pytest
+
+from evlav import download as dl
+from evlav.bench import serve_mirror
+
+DATA = bytes(range(256)) * 400
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    served = tmp_path / "mirror"
+    served.mkdir()
+    (served / "pkg.src.tar.gz").write_bytes(DATA)
+    server = serve_mirror(str(served))
+    url = f"http://127.0.0.1:{server.server_address[1]}/holo-main/pkg.src.tar.gz"
+    with dl.ConnectionPool() as pool:
+        yield pool, url, str(tmp_path / "pkg.src.tar.gz")
+    server.shutdown()
+    server.server_close()
+
+
+def read(fn):
+    with open(fn, "rb") as f:
+        return f.read()
+
+
+def test_download(mirror):
+    pool, url, fn = mirror
+    dl.download(pool, url, fn, len(DATA))
+    assert read(fn) == DATA
+    assert not os.path.exists(f"{fn}.tmp")
+    assert not os.path.exists(f"{fn}.lock")
+
+
+def test_resume(mirror):
+    pool, url, fn = mirror
+    with open(f"{fn}.tmp", "wb") as f:
+        f.write(DATA[:1000])
+    dl.download(pool, url, fn, len(DATA))
+    assert read(fn) == DATA
+
+
+def test_resume_complete(mirror):
+    # The server answers 416 for a range past the end of the file
+    pool, url, fn = mirror
+    with open(f"{fn}.tmp", "wb") as f:
+        f.write(DATA)
+    dl.download(pool, url, fn, len(DATA))
+    assert read(fn) == DATA
+
+
+def test_resume_invalid(mirror):
+    pool, url, fn = mirror
+    with open(f"{fn}.tmp", "wb") as f:
+        f.write(DATA + b"extra")
+    with pytest.raises(dl.DownloadError):
+        dl._download(pool, url, fn, len(DATA))
+    assert not os.path.exists(f"{fn}.tmp")
+    assert not os.path.exists(fn)
+
+
+def test_size_mismatch(mirror):
+    pool, url, fn = mirror
+    start = time.monotonic()
+    with pytest.raises(dl.SizeMismatchError):
+        dl.download(pool, url, fn, 2 * len(DATA), backoff=10)
+    # Raised without backing off between retries
+    assert time.monotonic() - start < 5
+    assert not os.path.exists(fn)
+    assert not os.path.exists(f"{fn}.tmp")
+
+
+def test_remote_size(mirror):
+    pool, url, _ = mirror
+    assert dl.get_remote_size(pool, url) == len(DATA)
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(dl, "SPLIT_SIZE", 4096)
+    monkeypatch.setattr(dl, "SEGMENT_SIZE", 4096)
+
+
+def test_split(mirror, small_segments):
+    pool, url, fn = mirror
+    dl.download(pool, url, fn, len(DATA), connections=4)
+    assert read(fn) == DATA
+    assert not os.path.exists(f"{fn}.parts")
+
+
+def test_split_resume(mirror, small_segments, monkeypatch):
+    pool, url, fn = mirror
+    fetch = dl.SplitDownload._fetch
+
+    def fail_after_three(self, fd, start):
+        if len(self.done) >= 3:
+            raise OSError("interrupted")
+        fetch(self, fd, start)
+
+    monkeypatch.setattr(dl.SplitDownload, "_fetch", fail_after_three)
+    with pytest.raises(dl.DownloadError):
+        dl.download(pool, url, fn, len(DATA), retries=1, connections=2)
+    assert not os.path.exists(fn)
+
+    monkeypatch.setattr(dl.SplitDownload, "_fetch", fetch)
+    dl.download(pool, url, fn, len(DATA))
+    assert read(fn) == DATA
+
+
+def test_split_interrupted_before_first_segment(mirror, small_segments, monkeypatch):
+    # The partial file is already extended to the full size, which must not
+    # be taken for a finished download
+    pool, url, fn = mirror
+    fetch = dl.SplitDownload._fetch
+
+    def fail(self, fd, start):
+        raise OSError("interrupted")
+
+    monkeypatch.setattr(dl.SplitDownload, "_fetch", fail)
+    with pytest.raises(dl.DownloadError):
+        dl.download(pool, url, fn, len(DATA), retries=1)
+    assert os.path.getsize(f"{fn}.tmp") == len(DATA)
+
+    monkeypatch.setattr(dl.SplitDownload, "_fetch", fetch)
+    dl.download(pool, url, fn, len(DATA))
+    assert read(fn) == DATA
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_cancel(mirror, monkeypatch, split):
+    pool, url, fn = mirror
+    monkeypatch.setattr(dl, "CHUNK_SIZE", 4096)
+    if split:
+        monkeypatch.setattr(dl, "SPLIT_SIZE", 4096)
+        monkeypatch.setattr(dl, "SEGMENT_SIZE", 16384)
+    cancel = threading.Event()
+    cancel.set()
+
+    start = time.monotonic()
+    with pytest.raises(dl.DownloadCancelled):
+        dl.download(pool, url, fn, len(DATA), backoff=10, cancel=cancel)
+    # Stopped after the first chunk, without retrying
+    assert time.monotonic() - start < 5
+    assert not os.path.exists(fn)
+    assert 0 < os.path.getsize(f"{fn}.tmp")
+    if not split:
+        assert os.path.getsize(f"{fn}.tmp") < len(DATA)
+
+
+def test_queue_close_cancels(tmp_path, monkeypatch):
+    from evlav.sources import DownloadQueue
+
+    monkeypatch.setattr(dl, "CHUNK_SIZE", 4096)
+    served = tmp_path / "mirror"
+    served.mkdir()
+    (served / "big.src.tar.gz").write_bytes(DATA * 20)
+    server = serve_mirror(str(served), rate=100000)
+    url = f"http://127.0.0.1:{server.server_address[1]}/holo-main/big.src.tar.gz"
+    fn = str(tmp_path / "big.src.tar.gz")
+    try:
+        downloads = DownloadQueue({fn: url})
+        stop = threading.Event()
+        threading.Timer(0.3, stop.set).start()
+        with pytest.raises(RuntimeError):
+            downloads.wait([fn], stop)
+
+        start = time.monotonic()
+        downloads.close()
+        assert time.monotonic() - start < 2
+        assert not os.path.exists(fn)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_existing_removes_lock(mirror):
+    # The lock file left for the processes that waited on another's download
+    pool, url, fn = mirror
+    with open(fn, "wb") as f:
+        f.write(DATA)
+    open(f"{fn}.lock", "w").close()
+    dl.download(pool, url, fn, len(DATA))
+    assert not os.path.exists(f"{fn}.lock")
@@ -0,0 +1,76 @@
+import logging
+
+import pytest
+
+from evlav.index import IndexParser, parse_index
+from evlav.metadata import MetadataStore
+
+
+def row(i, size="1.5 MiB"):
+    name = f"pkg{i % 7}-1.{i}-1.src.tar.gz"
+    date = f"2024-Jan-{1 + i // 10:02d} 10:{i % 60:02d}"
+    return (
+        f'<tr><td class="link"><a href="{name}" title="{name}">{name}</a></td>'
+        f'<td class="size">{size}</td><td class="date">{date}</td></tr>\n'
+    )
+
+
+def index(rows, tail="</tbody></table>"):
+    # A header row without a package, like the listings have
+    header = "<tr><th>Name</th><th>Size</th><th>Date</th></tr>\n"
+    return f'<table id="list"><tbody>{header}{"".join(rows)}{tail}'.encode()
+
+
+def full_parse(data):
+    parser = IndexParser()
+    parser.feed(data.decode("utf-8"))
+    return parser.packages
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MetadataStore(str(tmp_path))
+    yield store
+    store.db.close()
+
+
+def test_parse_index_delta(store, caplog):
+    caplog.set_level(logging.INFO)
+    rows = [row(i) for i in range(30)]
+    first = index(rows)
+    assert parse_index("list", first, store) == full_parse(first)
+
+    # Unchanged
+    assert parse_index("list", first, store) == full_parse(first)
+
+    # Appended
+    appended = index(rows + [row(i) for i in range(30, 35)])
+    assert parse_index("list", appended, store) == full_parse(appended)
+    # The former last row also held the end of the table body
+    assert "Parsed 6 new rows" in caplog.text
+
+    # Edited, with a row removed
+    edited = rows + [row(i) for i in range(30, 35)]
+    edited[3] = row(3, "2.0 MiB")
+    del edited[10]
+    edited = index(edited)
+    assert parse_index("list", edited, store) == full_parse(edited)
+    assert "Parsed 1 new rows" in caplog.text
+
+
+@pytest.mark.parametrize(
+    "layout",
+    [
+        # No end of the table, parsed in full
+        lambda rows: index(rows, tail=""),
+        # Upper case rows, split with the regex
+        lambda rows: index([r.replace("<tr>", "<TR>") for r in rows]),
+    ],
+)
+def test_parse_index_other_layouts(store, layout):
+    first = layout([row(i) for i in range(10)])
+    assert parse_index("list", first, store) == full_parse(first)
+    assert parse_index("list", first, store) == full_parse(first)
+
+    appended = layout([row(i) for i in range(12)])
+    assert parse_index("list", appended, store) == full_parse(appended)
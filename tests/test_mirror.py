@@ -0,0 +1,77 @@
+import subprocess
+import tarfile
+
+import pytest
+
+from evlav.mirror import get_refs, import_repo
+from evlav.sources import push_internal_repo
+
+
+def git(*args):
+    return subprocess.run(
+        ["git", "-c", "user.name=a", "-c", "user.email=a@b", *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    # A bare clone, as makepkg keeps them in the source package
+    work = tmp_path / "upstream"
+    git("init", "-q", "-b", "main", str(work))
+    (work / "README").write_text("x")
+    git("-C", str(work), "add", ".")
+    git("-C", str(work), "commit", "-qm", "init")
+    git("clone", "-q", "--bare", str(work), str(tmp_path / "repo.git"))
+    return tmp_path / "repo.git"
+
+
+def make_archive(fn, upstream=None):
+    with tarfile.open(fn, "w:gz") as tar:
+        tar.add(__file__, arcname="pkg/PKGBUILD")
+        if upstream:
+            tar.add(upstream, arcname="pkg/repo")
+
+
+def test_import_repo(tmp_path, upstream):
+    archive = tmp_path / "pkg-1-1.src.tar.gz"
+    make_archive(archive, upstream)
+    refs = import_repo(str(archive), "pkg/repo/", str(tmp_path / "mirror.git"))
+    assert refs == get_refs(str(upstream))
+    assert get_refs(str(tmp_path / "mirror.git")) == refs
+
+
+def test_import_missing_repo(tmp_path, upstream):
+    mirror = str(tmp_path / "mirror.git")
+    make_archive(tmp_path / "old.src.tar.gz", upstream)
+    import_repo(str(tmp_path / "old.src.tar.gz"), "pkg/repo/", mirror)
+
+    make_archive(tmp_path / "new.src.tar.gz")
+    with pytest.raises(RuntimeError):
+        import_repo(str(tmp_path / "new.src.tar.gz"), "pkg/repo/", mirror)
+    assert get_refs(mirror) == get_refs(str(upstream))
+
+
+def test_push_missing_repo(tmp_path, upstream):
+    # The remote must keep its refs when a newer archive lacks the repository
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    make_archive(cache / "pkg-1-1.src.tar.gz", upstream)
+    make_archive(cache / "pkg-2-1.src.tar.gz")
+    remote = tmp_path / "remote"
+    git("init", "-q", "--bare", str(remote / "repo"))
+
+    def push(name):
+        work = str(tmp_path / "work")
+        return push_internal_repo(
+            str(cache), work, str(remote), name, "pkg", "repo", "repo"
+        )
+
+    assert push("pkg-1-1.src.tar.gz")
+    before = get_refs(str(remote / "repo"))
+    assert before == get_refs(str(upstream))
+    with pytest.raises(RuntimeError):
+        push("pkg-2-1.src.tar.gz")
+    assert get_refs(str(remote / "repo")) == before
@@ -0,0 +1,84 @@
+import os
+import subprocess
+
+import pytest
+
+from evlav import bench
+from evlav.__main__ import _main
+
+
+def get_refs(git_dir):
+    out = subprocess.run(
+        [
+            "git",
+            "--git-dir",
+            git_dir,
+            "for-each-ref",
+            "--format=%(objectname) %(refname)",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return dict(line.split(" ")[::-1] for line in out.splitlines())
+
+
+def sync(root, url, internal_repos, *args):
+    remote = os.path.join(root, "remote")
+    bench.init_remotes(remote, internal_repos)
+    _main(
+        [
+            "--sources",
+            url,
+            "--repo",
+            *bench.REPOS,
+            "--cache",
+            os.path.join(root, "cache"),
+            "--remote",
+            remote,
+            "--work",
+            os.path.join(root, "work"),
+            "--version",
+            *bench.VERSIONS,
+            *args,
+        ]
+    )
+    return {
+        repo: get_refs(os.path.join(remote, repo))
+        for repo in bench.REPOS + internal_repos
+    }
+
+
+@pytest.fixture(scope="module")
+def mirror(tmp_path_factory):
+    mirror = str(tmp_path_factory.mktemp("mirror"))
+    internal_repos = bench.generate_mirror(mirror, 3, 8, 1024, 1)
+    server = bench.serve_mirror(mirror)
+    yield f"http://127.0.0.1:{server.server_address[1]}", internal_repos
+    server.shutdown()
+    server.server_close()
+
+
+def test_fast_import_matches_worktree(tmp_path, mirror):
+    url, internal_repos = mirror
+    worktree = sync(str(tmp_path / "worktree"), url, internal_repos)
+    fast_import = sync(str(tmp_path / "fast"), url, internal_repos, "--fast-import")
+    assert worktree == fast_import
+
+    # The history covers a fork point and removed files
+    remote = str(tmp_path / "worktree" / "remote" / "holo")
+    refs = worktree["holo"]
+    assert {"refs/heads/main", "refs/heads/3.5"} <= refs.keys()
+    fork = subprocess.run(
+        ["git", "--git-dir", remote, "merge-base", "main", "3.5"],
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    assert fork and fork != refs["refs/heads/3.5"]
+    removed = subprocess.run(
+        ["git", "--git-dir", remote, "log", "--diff-filter=D", "--format=%H", "main"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert removed
@@ -0,0 +1,8 @@
+from evlav.trace import _cmd_name
+
+
+def test_cmd_name():
+    assert _cmd_name(["git", "-C", "/repo", "push", "origin"]) == "git push"
+    assert _cmd_name(["git", "--git-dir", "/m.git", "push", "--mirror"]) == "git push"
+    assert _cmd_name(["git", "--work-tree", "/w", "-c", "a=b", "add", "."]) == "git add"
+    assert _cmd_name(["git", "--version"]) == "git"
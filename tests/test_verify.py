@@ -0,0 +1,17 @@
+import pytest
+
+from evlav.download import SizeMismatchError
+from evlav.verify import check_index_size
+
+
+def test_index_size_any_index():
+    check_index_size("pkg.src.tar.gz", 2000, {1000, 2000})
+
+
+def test_index_size_unlisted():
+    check_index_size("pkg.src.tar.gz", 2000, set())
+
+
+def test_index_size_mismatch():
+    with pytest.raises(SizeMismatchError):
+        check_index_size("pkg.src.tar.gz", 3000, {1000, 2000})